@@ -0,0 +1,250 @@
+# Incremental Training:   Same model as `python -m rasa_nlu.train`, without redoing
+#                         the work the last run already did. The spaCy parse of each
+#                         example is cached under a hash of its text, and a component
+#                         whose inputs didn't change is reused as it is. The sklearn
+#                         intent classifier and the CRF train side by side, in a
+#                         process pool. Run from the Agent directory, like train_model.py:
+#
+#                             python train_incremental.py -c config_spacy.json
+
+import os
+import json
+import time
+import pickle
+import hashlib
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = "./models/.cache"
+DOCS_CACHE = "spacy_docs.pkl"
+COMPONENTS_CACHE = "components.pkl"
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Cache files
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def load_cache(path):
+    try:
+        with open(path, "rb") as cache_file:
+            return pickle.load(cache_file)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return {}
+
+
+def save_cache(path, cache):
+    ''' Written to a temp file first, an interrupted run leaves the old cache '''
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as cache_file:
+        pickle.dump(cache, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+
+def content_hash(*parts):
+    digest = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = repr(part).encode("utf-8")
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Featurization with the spaCy docs cache
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def featurize_spacy(component, training_data, config, docs_cache, report):
+    ''' nlp_spacy's train(): sets the spacy_doc of every example. Docs of texts
+        parsed by an earlier run are restored from their bytes, the new
+        ones are parsed together with nlp.pipe. Returns the docs cache
+        for the next run, holding only the current examples '''
+    from spacy.tokens import Doc
+
+    nlp = component.nlp
+    model_name = config["spacy_model_name"]
+    new_cache = {}
+    to_parse = []
+
+    for example in training_data.training_examples:
+        key = content_hash(model_name, example.text)
+        doc_bytes = docs_cache.get(key)
+
+        if doc_bytes is not None:
+            example.set("spacy_doc", Doc(nlp.vocab).from_bytes(doc_bytes))
+            new_cache[key] = doc_bytes
+            report['docs_reused'] += 1
+        else:
+            to_parse.append((key, example))
+
+    for (key, example), doc in zip(to_parse, nlp.pipe([example.text for _, example in to_parse])):
+        example.set("spacy_doc", doc)
+        new_cache[key] = doc.to_bytes()
+    report['docs_parsed'] = len(to_parse)
+
+    return new_cache
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Components trained on the process pool. The workers get no spaCy
+# docs (they don't pickle), only the features computed from them
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def intent_classifier_inputs(component, training_data, config):
+    ''' The feature vectors and intents the classifier trains on '''
+    from rasa_nlu.training_data import Message, TrainingData
+
+    examples = [Message(example.text, {"intent": example.get("intent"),
+                                       "text_features": example.get("text_features")})
+                for example in training_data.intent_examples]
+    inputs = (TrainingData(training_examples=examples), {"num_threads": config["num_threads"]})
+    key = content_hash(*[(example.get("intent"), example.get("text_features").tobytes())
+                         for example in examples])
+
+    return inputs, key
+
+
+def train_intent_classifier(component, training_data, config):
+    component.train(training_data, config)
+    return component
+
+
+def crf_inputs(component, training_data, config):
+    ''' The CRF dataset (words, POS tags and labels) the extractor trains on '''
+    component.BILOU_flag = config["entity_crf_BILOU_flag"]
+    component.crf_features = config["entity_crf_features"]
+
+    dataset = component._create_dataset(training_data.entity_examples) \
+        if training_data.entity_examples else []
+    key = content_hash(component.BILOU_flag, component.crf_features, dataset)
+
+    return (dataset,), key
+
+
+def train_crf(component, dataset):
+    if dataset:
+        component._train_model(dataset)
+    return component
+
+
+PARALLEL_TRAINING = {
+    "intent_classifier_sklearn": (intent_classifier_inputs, train_intent_classifier),
+    "ner_crf": (crf_inputs, train_crf),
+}
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Training
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def train(config, cache_dir=CACHE_DIR, parallel=True):
+    ''' Trains and persists the model described by config (a RasaNLUConfig).
+        Returns the new model directory and a report of what was reused '''
+    from rasa_nlu.converters import load_data
+    from rasa_nlu.model import Trainer
+
+    start = time.perf_counter()
+    report = {'docs_reused': 0, 'docs_parsed': 0,
+              'components_reused': [], 'components_trained': []}
+
+    os.makedirs(cache_dir, exist_ok=True)
+    docs_cache = load_cache(os.path.join(cache_dir, DOCS_CACHE))
+    components_cache = load_cache(os.path.join(cache_dir, COMPONENTS_CACHE))
+
+    training_data = load_data(config["data"])
+    trainer = Trainer(config)
+
+    # Same context handling as Trainer.train
+    context = {}
+    for component in trainer.pipeline:
+        updates = component.provide_context()
+        if updates:
+            context.update(updates)
+
+    # The sequential part of the pipeline: featurizers and cheap extractors
+    deferred = []
+    for position, component in enumerate(trainer.pipeline):
+        if component.name == "nlp_spacy":
+            docs_cache = featurize_spacy(component, training_data, config, docs_cache, report)
+        elif component.name in PARALLEL_TRAINING:
+            deferred.append(position)
+        else:
+            updates = component.train(training_data, config, **context)
+            if updates:
+                context.update(updates)
+    report['featurization_seconds'] = time.perf_counter() - start
+
+    # The expensive components, unless their inputs are the same as last time
+    jobs = []
+    new_components_cache = {}
+    for position in deferred:
+        component = trainer.pipeline[position]
+        make_inputs, train_component = PARALLEL_TRAINING[component.name]
+        inputs, key = make_inputs(component, training_data, config)
+
+        cached = components_cache.get(component.name)
+        if cached is not None and cached[0] == key:
+            trainer.pipeline[position] = pickle.loads(cached[1])
+            new_components_cache[component.name] = cached
+            report['components_reused'].append(component.name)
+        else:
+            jobs.append((position, key, train_component, inputs))
+
+    train_start = time.perf_counter()
+    if parallel and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=len(jobs)) as pool:
+            futures = [(position, key, pool.submit(train_component, trainer.pipeline[position], *inputs))
+                       for position, key, train_component, inputs in jobs]
+            trained = [(position, key, future.result()) for position, key, future in futures]
+    else:
+        trained = [(position, key, train_component(trainer.pipeline[position], *inputs))
+                   for position, key, train_component, inputs in jobs]
+
+    for position, key, component in trained:
+        trainer.pipeline[position] = component
+        new_components_cache[component.name] = (key, pickle.dumps(component, protocol=pickle.HIGHEST_PROTOCOL))
+        report['components_trained'].append(component.name)
+    report['training_seconds'] = time.perf_counter() - train_start
+
+    trainer.training_data = training_data
+    model_dir = trainer.persist(config["path"])
+
+    save_cache(os.path.join(cache_dir, DOCS_CACHE), docs_cache)
+    save_cache(os.path.join(cache_dir, COMPONENTS_CACHE), new_components_cache)
+
+    report['total_seconds'] = time.perf_counter() - start
+    return model_dir, report
+
+
+def log_report(model_dir, report):
+    logger.info("Model saved to %s in %.1fs", model_dir, report['total_seconds'])
+    logger.info("spaCy docs: %d reused, %d parsed (%.1fs)",
+                report['docs_reused'], report['docs_parsed'], report['featurization_seconds'])
+    logger.info("Components: reused %s, trained %s (%.1fs)",
+                ", ".join(report['components_reused']) or "none",
+                ", ".join(report['components_trained']) or "none",
+                report['training_seconds'])
+
+
+if __name__ == "__main__":
+    from rasa_nlu.config import RasaNLUConfig
+
+    parser = argparse.ArgumentParser(description="Incrementally train a RasaNLU model")
+    parser.add_argument("-c", "--config", default="config_spacy.json")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--sequential", action="store_true",
+                        help="train the classifier and the CRF one after the other")
+    parser.add_argument("--report", help="also write the report as JSON to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    model_dir, report = train(RasaNLUConfig(args.config), args.cache_dir, not args.sequential)
+    log_report(model_dir, report)
+
+    if args.report:
+        with open(args.report, "w") as report_file:
+            json.dump(dict(report, model_dir=model_dir), report_file, indent=4)
@@ -0,0 +1,146 @@
+# MicroBatcher:    Collects the getResponse calls of concurrent requests for a
+#                  short window (or until max_batch of them are waiting) and
+#                  parses their sentences with a single parse_texts call, then
+#                  answers them in arrival order, so every user's requests are
+#                  handled in the order they came. A bounded queue and a
+#                  maximum wait keep the latency bounded under overload.
+
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(RuntimeError):
+    ''' The request was rejected, too many are waiting already '''
+
+
+class MicroBatcher():
+    ''' getResponse for many threads, with the parsing batched. The
+        batches are parsed and answered by a single collector thread '''
+
+    def __init__(self, agent, window=0.005, max_batch=32, max_pending=1000, max_wait=1.0):
+        self.agent = agent
+        self.window = window
+        self.max_batch = max(1, max_batch)
+        self.max_pending = max_pending
+        self.max_wait = max_wait
+
+        # (user_id, input_text, mode, enqueued, Future), oldest first
+        self.queue = deque()
+        self.queue_changed = threading.Condition()
+        self.stopped = False
+
+        self.batches = 0
+        self.batched_requests = 0
+        self.rejected = 0
+        self.expired = 0
+
+        self.collector = threading.Thread(target=self.collect, name="micro-batcher", daemon=True)
+        self.collector.start()
+
+    def submit(self, input_text, user_id, mode=None):
+        ''' Returns a Future of the response, projected with mode. Raises
+            Overloaded if max_pending requests are waiting already. Canceling
+            the Future before its batch is collected drops the request '''
+        future = Future()
+
+        with self.queue_changed:
+            if self.stopped:
+                raise RuntimeError("The batcher is stopped")
+            if len(self.queue) >= self.max_pending:
+                self.rejected += 1
+                raise Overloaded("%d requests are waiting already" % len(self.queue))
+
+            self.queue.append((user_id, input_text, mode, time.perf_counter(), future))
+            if len(self.queue) >= self.max_batch:
+                self.queue_changed.notify()
+            elif len(self.queue) == 1:
+                # Starts the window
+                self.queue_changed.notify()
+
+        return future
+
+    def getResponse(self, input_text, user_id='kimonas', timeout=None, mode=None):
+        return self.submit(input_text, user_id, mode).result(timeout)
+
+    def next_batch(self):
+        ''' Waits for the first request, then for the rest of the window
+            unless max_batch requests come first. None once stopped '''
+        with self.queue_changed:
+            while not self.queue and not self.stopped:
+                self.queue_changed.wait()
+            if self.stopped and not self.queue:
+                return None
+
+            deadline = self.queue[0][3] + self.window
+            while len(self.queue) < self.max_batch and not self.stopped:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self.queue_changed.wait(remaining)
+
+            size = min(self.max_batch, len(self.queue))
+            return [self.queue.popleft() for _ in range(size)]
+
+    def collect(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                break
+
+            # Requests that waited longer than max_wait are dropped before parsing,
+            # their callers are likely gone and they would delay the rest
+            now = time.perf_counter()
+            live = []
+            for user_id, input_text, mode, enqueued, future in batch:
+                self.agent.metrics.observe('queue', now - enqueued)
+                # False if the caller canceled it meanwhile
+                if not future.set_running_or_notify_cancel():
+                    continue
+                if self.max_wait is not None and now - enqueued > self.max_wait:
+                    self.expired += 1
+                    future.set_exception(Overloaded("Waited %.3fs in the queue" % (now - enqueued)))
+                else:
+                    live.append((user_id, input_text, mode, future))
+
+            if live:
+                self.process(live)
+
+    def process(self, batch):
+        texts = [input_text for _, input_text, _, _ in batch]
+        try:
+            predictions = self.agent.parse_texts(texts)
+        except Exception as error:
+            logger.exception("Could not parse a batch of %d sentences", len(texts))
+            for _, _, _, future in batch:
+                future.set_exception(error)
+            return
+
+        self.batches += 1
+        self.batched_requests += len(batch)
+
+        # In arrival order, which keeps each user's requests in order
+        for (user_id, input_text, mode, future), prediction in zip(batch, predictions):
+            try:
+                future.set_result(self.agent.getResponse(input_text, user_id, prediction, mode))
+            except Exception as error:
+                logger.exception("Request of %s failed", user_id)
+                future.set_exception(error)
+
+    def stats(self):
+        return {'waiting': len(self.queue),
+                'batches': self.batches,
+                'mean_batch': self.batched_requests / self.batches if self.batches else 0.0,
+                'rejected': self.rejected,
+                'expired': self.expired}
+
+    def close(self):
+        ''' Stops taking requests, the waiting ones are still answered '''
+        with self.queue_changed:
+            self.stopped = True
+            self.queue_changed.notify()
+        self.collector.join()
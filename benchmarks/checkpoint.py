@@ -0,0 +1,75 @@
+# Sessions checkpoint/restore benchmark. --live users go through a few dialogs
+# of the synthetic agent, their sessions are checkpointed, and the checkpoint
+# is grown to --sessions entries by repeating them under other user_ids. Then:
+#   checkpoint   writing the live sessions (serialized under their user's lock)
+#   restore      AgentModel.restore_sessions of the whole file, what a restart waits for
+#   first use    loading a restored session on its user's next request
+#
+# Run from the repository root:
+#   python -m benchmarks.checkpoint
+#   python -m benchmarks.checkpoint --sessions 200000 --live 5000
+
+import os
+import random
+import argparse
+import tempfile
+from contextlib import redirect_stdout
+from time import perf_counter
+
+from structures.checkpoint import write_checkpoint, read_checkpoint
+from benchmarks.dialogue import make_model, workload, LONG_LIFESPAN
+
+
+def main(args):
+    model = make_model(args.tasks, LONG_LIFESPAN)
+    with redirect_stdout(open(os.devnull, "w")):
+        for user_id, text in workload(args.live, args.dialogs, args.tasks):
+            model.getResponse(text, user_id)
+
+    path = args.path or os.path.join(tempfile.mkdtemp(), "sessions.ckpt")
+
+    start = perf_counter()
+    live = model.checkpoint_sessions(path)
+    checkpoint_seconds = perf_counter() - start
+    bytes_per_session = os.path.getsize(path) / max(1, live)
+
+    # The same sessions over and over, under new user_ids
+    templates = list(read_checkpoint(path))
+    entries = (("restored-%d" % index,) + templates[index % len(templates)][1:]
+               for index in range(args.sessions))
+    write_checkpoint(path, entries)
+
+    restored = make_model(args.tasks, LONG_LIFESPAN)
+    start = perf_counter()
+    count = restored.restore_sessions(path)
+    restore_seconds = perf_counter() - start
+
+    sample = random.Random(0).sample(list(restored.sessions.restored), min(args.sample, count))
+    start = perf_counter()
+    for user_id in sample:
+        restored.sessions.get_or_create(user_id)
+    first_use = (perf_counter() - start) / max(1, len(sample))
+
+    print("%-28s %12d" % ("live sessions", live))
+    print("%-28s %12.2f" % ("checkpoint s", checkpoint_seconds))
+    print("%-28s %12.0f" % ("checkpoint sessions/s", live / checkpoint_seconds))
+    print("%-28s %12.0f" % ("bytes/session", bytes_per_session))
+    print("%-28s %12d" % ("restored sessions", count))
+    print("%-28s %12.1f" % ("checkpoint file MB", os.path.getsize(path) / 2 ** 20))
+    print("%-28s %12.2f" % ("restore s", restore_seconds))
+    print("%-28s %12.1f" % ("first use us/session", 1e6 * first_use))
+    print("%-28s %12.2f" % ("eager restore s (estimate)", restore_seconds + first_use * count))
+
+    if not args.path:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sessions checkpoint/restore benchmark")
+    parser.add_argument("--sessions", type=int, default=1000000, help="sessions in the restored checkpoint")
+    parser.add_argument("--live", type=int, default=20000, help="users that go through the dialogs")
+    parser.add_argument("--dialogs", type=int, default=2, help="dialogs per live user")
+    parser.add_argument("--tasks", type=int, default=10, help="task groups in the synthetic agent")
+    parser.add_argument("--sample", type=int, default=10000, help="restored sessions loaded for first use")
+    parser.add_argument("--path", help="keep the checkpoint in this file")
+    main(parser.parse_args())
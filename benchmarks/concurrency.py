@@ -0,0 +1,160 @@
+# Concurrency stress benchmark. Many threads call getResponse on one AgentModel
+# and the throughput is reported per number of threads. The stub interpreter
+# sleeps for --parse-ms per sentence, standing in for RasaNLU's parse, which
+# runs outside the user locks (and mostly outside the GIL, in spaCy/numpy).
+# After every run the users' sessions are checked for consistency.
+#
+# Run from the repository root:
+#   python -m benchmarks.concurrency
+#   python -m benchmarks.concurrency --threads 1,8 --shared    # threads share users
+
+import os
+import time
+import random
+import argparse
+import threading
+from contextlib import redirect_stdout
+from time import perf_counter
+
+from model_handler import AgentModel
+from benchmarks.dialogue import synthetic_agent, StubInterpreter, dialog, SCENARIOS
+
+
+class SlowStubInterpreter(StubInterpreter):
+    ''' StubInterpreter taking delay seconds per sentence '''
+
+    def __init__(self, intent_names, delay):
+        StubInterpreter.__init__(self, intent_names)
+        self.delay = delay
+
+    def parse(self, text):
+        if self.delay:
+            time.sleep(self.delay)
+        return StubInterpreter.parse(self, text)
+
+
+def make_model(num_tasks, delay):
+    intents, contexts = synthetic_agent(num_tasks)
+
+    with redirect_stdout(open(os.devnull, "w")):
+        return AgentModel(interpreter=SlowStubInterpreter(intents, delay), intents=intents,
+                          contexts=contexts, fallback_responses=["Could you repeat that?"],
+                          parse_cache_size=0)
+
+
+def conversations(users, dialogs_per_user, num_tasks, seed=0):
+    ''' {user_id: [texts]} of random dialogs '''
+    rng = random.Random(seed)
+
+    return {"user-%d" % user: [text for _ in range(dialogs_per_user)
+                               for text in dialog(rng.choice(SCENARIOS), rng.randrange(num_tasks))]
+            for user in range(users)}
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Consistency checks
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def session_problems(user_id, session):
+    ''' Broken links between a session's intents, IIS and view '''
+    problems = []
+
+    pending = [record.request for record in session.intents if record.request is not None]
+    if len(pending) != len(session.iis) \
+       or any(not any(request is entry for entry in session.iis) for request in pending) \
+       or any(entry.record not in session.intents for entry in session.iis):
+        problems.append("%s: the IIS doesn't match the incomplete intents" % user_id)
+
+    session.invalidate_view()
+    view = session.get_view()
+    if list(view.contexts) != list(reversed(list(session.contexts))) \
+       or list(view.intents) != [record.name for record in session.intents]:
+        problems.append("%s: the view doesn't match the session" % user_id)
+
+    return problems
+
+
+def intent_trace(responses):
+    return [(response['intent']['name'], tuple(response['active_intents'])) for response in responses]
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Runs
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def run_threads(model, convs, threads, shared):
+    ''' Each thread plays whole conversations. With shared, the turns of
+        every user are spread over all the threads instead.
+        Returns (requests/s, {user_id: responses}) '''
+    responses = {user_id: [] for user_id in convs}
+    errors = []
+
+    if shared:
+        # Thread i sends the turns i, i + threads, ... of every user. A user's
+        # turns then arrive in any order, only the invariants can be checked
+        jobs = [[(user_id, text) for user_id, texts in convs.items() for text in texts[index::threads]]
+                for index in range(threads)]
+    else:
+        user_ids = sorted(convs)
+        jobs = [[(user_id, text) for user_id in user_ids[index::threads] for text in convs[user_id]]
+                for index in range(threads)]
+
+    def work(requests):
+        try:
+            for user_id, text in requests:
+                responses[user_id].append(model.getResponse(text, user_id))
+        except Exception as error:
+            errors.append(error)
+
+    workers = [threading.Thread(target=work, args=(requests,)) for requests in jobs]
+
+    start = perf_counter()
+    with redirect_stdout(open(os.devnull, "w")):
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    total = perf_counter() - start
+
+    if errors:
+        raise errors[0]
+
+    return sum(len(texts) for texts in convs.values()) / total, responses
+
+
+def main(args):
+    delay = args.parse_ms / 1000.0
+    convs = conversations(args.users, args.dialogs, args.tasks)
+
+    # The reference: every user's conversation played by a single thread
+    _, expected = run_threads(make_model(args.tasks, 0), convs, 1, False)
+
+    print("%-10s %12s %10s %10s" % ("threads", "requests/s", "speedup", "problems"))
+    base = None
+    for threads in args.threads:
+        model = make_model(args.tasks, delay)
+        throughput, responses = run_threads(model, convs, threads, args.shared)
+        base = base or throughput
+
+        problems = []
+        for user_id in convs:
+            problems.extend(session_problems(user_id, model.sessions[user_id]))
+            if not args.shared and intent_trace(responses[user_id]) != intent_trace(expected[user_id]):
+                problems.append("%s: different replies than with one thread" % user_id)
+
+        print("%-10d %12.0f %10.2f %10d" % (threads, throughput, throughput / base, len(problems)))
+        for problem in problems[:5]:
+            print("    " + problem)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="AgentModel concurrency stress benchmark")
+    parser.add_argument("--threads", default="1,2,4,8,16",
+                        type=lambda value: [int(threads) for threads in value.split(",")])
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--dialogs", type=int, default=5, help="dialogs per user")
+    parser.add_argument("--tasks", type=int, default=10, help="task groups in the synthetic agent")
+    parser.add_argument("--parse-ms", type=float, default=2.0, help="time the stub takes per sentence")
+    parser.add_argument("--shared", action="store_true",
+                        help="spread each user's turns over all the threads")
+    main(parser.parse_args())
@@ -0,0 +1,366 @@
+# Dialogue engine benchmarks. AgentModel runs with a deterministic stub in place
+# of the RasaNLU interpreter, so nothing of spaCy, duckling or the pickled
+# classifiers is loaded, and synthetic multi-turn dialogs go through getResponse.
+#
+# Run from the repository root:
+#   python -m benchmarks.dialogue                       # the dialogue engine
+#   python -m benchmarks.dialogue --only users,iis      # some of the scaling tables
+#   python -m benchmarks.dialogue --real Agent/models/model_001   # RasaNLU stages
+
+import os
+import sys
+import json
+import random
+import argparse
+import tracemalloc
+from contextlib import redirect_stdout
+from time import perf_counter
+
+from model_handler import AgentModel
+
+LONG_LIFESPAN = [60, 1000000]
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Synthetic agent and stub interpreter
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def synthetic_agent(num_tasks, lifespan=None):
+    ''' INTENTS/CONTEXTS with num_tasks groups of intents:
+        "Task i" needs 'item' and 'when' and sets the "Task i Done" context,
+        "Follow i" follows up "Task i" and "Edit i" needs "Task i Done".
+        By default the lifespans are short enough for entries to expire '''
+
+    intents = {
+        "Information": {"tag": "Information", "parameters": [], "persistence_responses": {},
+                        "response": ["Thank you"], "lifespan": [0, 0]},
+        "Cancel": {"tag": "Cancel", "parameters": [], "persistence_responses": {},
+                   "response": ["Stopped!"], "lifespan": [0, 0]},
+        "Positive": {"tag": "Positive", "parameters": [], "persistence_responses": {},
+                     "response": ["Great", "Nice"], "lifespan": lifespan or [1, 3]},
+    }
+    contexts = {}
+
+    for task in range(num_tasks):
+        intents["Task %d" % task] = {
+            "tag": "Task %d" % task,
+            "parameters": ["item", "when"],
+            "persistence_responses": {"item": ["Which item?", "What should I add?"],
+                                      "when": ["When should $item happen?"]},
+            "response": ["Added $item at $when.", "Ok, $item at $when."],
+            "context_set": "Task %d Done" % task,
+            "lifespan": lifespan or [5, 6],
+        }
+        intents["Follow %d" % task] = {
+            "tag": "Follow %d" % task, "parameters": [], "persistence_responses": {},
+            "response": ["Following up on $intent-item"],
+            "follow_up": ["Task %d" % task],
+            "lifespan": lifespan or [5, 2],
+        }
+        intents["Edit %d" % task] = {
+            "tag": "Edit %d" % task, "parameters": [], "persistence_responses": {},
+            "response": ["Editing $context-item"],
+            "context_needed": ["Task %d Done" % task],
+            "lifespan": lifespan or [5, 2],
+        }
+        contexts["Task %d Done" % task] = {"lifespan": lifespan or [5, 4]}
+
+    return intents, contexts
+
+
+class StubInterpreter():
+    ''' Deterministic stand-in for the RasaNLU Interpreter. Sentences are
+        written as "<intent>|<entity>=<value>,..." and are parsed to that
+        intent, ranked above a few fixed lower-confidence candidates '''
+
+    def __init__(self, intent_names, candidates=3):
+        self.intent_names = sorted(intent_names)
+        self.candidates = candidates
+
+    def parse(self, text):
+        name, _, entities_text = text.partition("|")
+
+        entities = []
+        for pair in filter(None, entities_text.split(",")):
+            entity, _, value = pair.partition("=")
+            entities.append({"entity": entity, "value": value, "start": 0,
+                             "end": len(value), "extractor": "stub"})
+
+        intent_ranking = [{"name": name, "confidence": 0.9}]
+        offset = len(name)
+        for candidate in range(self.candidates):
+            other = self.intent_names[(offset + 7 * candidate) % len(self.intent_names)]
+            if other != name:
+                intent_ranking.append({"name": other, "confidence": 0.02})
+
+        return {"intent": dict(intent_ranking[0]), "intent_ranking": intent_ranking,
+                "entities": entities, "text": text}
+
+
+def make_model(num_tasks=10, lifespan=None):
+    intents, contexts = synthetic_agent(num_tasks, lifespan)
+
+    # The parse cache is off, every request goes through the stub
+    with redirect_stdout(open(os.devnull, "w")):
+        return AgentModel(interpreter=StubInterpreter(intents), intents=intents,
+                          contexts=contexts, fallback_responses=["Could you repeat that?"],
+                          parse_cache_size=0)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Dialogs
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def dialog(kind, task):
+    ''' The turns of one scenario on the given task group '''
+    full = "Task %d|item=box,when=5pm" % task
+
+    if kind == "full":
+        return [full]
+    if kind == "slots":
+        # Information slot-filling, one parameter per turn
+        return ["Task %d|" % task, "Information|item=box", "Information|when=5pm"]
+    if kind == "cancel":
+        return ["Task %d|item=box" % task, "Cancel|"]
+    if kind == "follow_up":
+        return [full, "Follow %d|" % task]
+    if kind == "context":
+        return [full, "Edit %d|" % task]
+    if kind == "expiry":
+        # The context has expired by the time "Edit" comes, so it falls back
+        return [full] + ["Positive|"] * 4 + ["Edit %d|" % task]
+
+    raise ValueError("Unknown dialog kind '%s'" % kind)
+
+
+SCENARIOS = ["full", "slots", "cancel", "follow_up", "context", "expiry"]
+
+
+def workload(users, dialogs_per_user, num_tasks, seed=0):
+    ''' (user_id, text) requests of random dialogs. The users' turns are
+        interleaved round-robin, as they would arrive from many clients '''
+    rng = random.Random(seed)
+
+    conversations = []
+    for user in range(users):
+        turns = []
+        for _ in range(dialogs_per_user):
+            turns.extend(dialog(rng.choice(SCENARIOS), rng.randrange(num_tasks)))
+        conversations.append(("user-%d" % user, turns))
+
+    requests = []
+    for turn in range(max(len(turns) for _, turns in conversations)):
+        for user_id, turns in conversations:
+            if turn < len(turns):
+                requests.append((user_id, turns[turn]))
+
+    return requests
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Measurements
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run_requests(model, requests):
+    ''' Returns (requests/s, p50 ms, p99 ms) of getResponse '''
+    latencies = []
+
+    with redirect_stdout(open(os.devnull, "w")):
+        start = perf_counter()
+        for user_id, text in requests:
+            request_start = perf_counter()
+            model.getResponse(text, user_id)
+            latencies.append(perf_counter() - request_start)
+        total = perf_counter() - start
+
+    latencies.sort()
+    return (len(requests) / total,
+            1000 * percentile(latencies, 0.50),
+            1000 * percentile(latencies, 0.99))
+
+
+def session_memory(model, requests):
+    ''' Bytes held per session after running the requests '''
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    with redirect_stdout(open(os.devnull, "w")):
+        for user_id, text in requests:
+            model.getResponse(text, user_id)
+
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return size / max(1, len(model.sessions))
+
+
+def prefill(model, users, turns):
+    ''' Setup turns, not measured '''
+    with redirect_stdout(open(os.devnull, "w")):
+        for user in range(users):
+            for text in turns:
+                model.getResponse(text, "user-%d" % user)
+
+
+def print_row(label, value, result, memory=None):
+    throughput, p50, p99 = result
+    line = "%-10s %10s %12.0f %10.3f %10.3f" % (label, value, throughput, p50, p99)
+    if memory is not None:
+        line += " %12.0f" % memory
+    print(line)
+
+
+def print_header(title, with_memory=False):
+    print("")
+    print(title)
+    header = "%-10s %10s %12s %10s %10s" % ("scaling", "value", "requests/s", "p50 ms", "p99 ms")
+    if with_memory:
+        header += " %12s" % "bytes/user"
+    print(header)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Scaling tables
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def bench_scenarios(args):
+    print_header("Scenarios (%d users)" % args.users)
+    for kind in SCENARIOS:
+        model = make_model(args.tasks)
+        requests = [("user-%d" % user, text)
+                    for _ in range(args.dialogs)
+                    for user in range(args.users)
+                    for text in dialog(kind, user % args.tasks)]
+        print_row("scenario", kind, run_requests(model, requests))
+
+
+def bench_users(args):
+    print_header("Number of users", with_memory=True)
+    for users in [1, 100, 1000, 10000]:
+        requests = workload(users, max(1, args.dialogs * args.users // users), args.tasks)
+        result = run_requests(make_model(args.tasks), requests)
+        memory = session_memory(make_model(args.tasks), workload(users, 1, args.tasks, seed=1))
+        print_row("users", users, result, memory)
+
+
+def bench_contexts(args):
+    print_header("Active contexts per user")
+    for active in [1, 10, 100]:
+        model = make_model(max(active, args.tasks), LONG_LIFESPAN)
+        prefill(model, args.users, ["Task %d|item=box,when=5pm" % task for task in range(active)])
+
+        requests = [("user-%d" % user, text)
+                    for _ in range(args.dialogs)
+                    for user in range(args.users)
+                    for text in ["Edit %d|" % (user % active), "Positive|"]]
+        print_row("contexts", active, run_requests(model, requests))
+
+
+def bench_intents(args):
+    print_header("Intents in the agent")
+    for tasks in [10, 100, 1000]:
+        model = make_model(tasks)
+        print_row("intents", 3 * tasks + 3, run_requests(model, workload(args.users, args.dialogs, tasks)))
+
+
+def bench_iis(args):
+    print_header("Incomplete intents stack depth")
+    for depth in [1, 10, 100]:
+        model = make_model(max(depth, args.tasks), LONG_LIFESPAN)
+        prefill(model, args.users, ["Task %d|" % task for task in range(depth)])
+
+        requests = [("user-%d" % user, text)
+                    for _ in range(args.dialogs)
+                    for user in range(args.users)
+                    for text in ["Task %d|" % (user % depth), "Information|item=box", "Positive|"]]
+        print_row("iis", depth, run_requests(model, requests))
+
+
+BENCHMARKS = {
+    "scenarios": bench_scenarios,
+    "users": bench_users,
+    "contexts": bench_contexts,
+    "intents": bench_intents,
+    "iis": bench_iis,
+}
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Real RasaNLU pipeline
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def bench_pipeline(model_dir, conf_file, rounds):
+    ''' Load time and per-sentence latency of each component of a trained model '''
+    from rasa_nlu.model import Metadata, Interpreter
+    from rasa_nlu.config import RasaNLUConfig
+    from rasa_nlu.training_data import Message
+    from nlu_pipeline import parse_batch
+
+    start = perf_counter()
+    interpreter = Interpreter.load(Metadata.load(model_dir), RasaNLUConfig(conf_file))
+    print("Loaded %s in %.2f s" % (model_dir, perf_counter() - start))
+
+    with open(os.path.join(model_dir, "training_data.json")) as data_file:
+        examples = json.load(data_file)["rasa_nlu_data"]["common_examples"]
+    sentences = [example["text"] for example in examples]
+
+    timings = {component.name: [] for component in interpreter.pipeline}
+    for _ in range(rounds):
+        for sentence in sentences:
+            message = Message(sentence, interpreter.default_output_attributes())
+            for component in interpreter.pipeline:
+                component_start = perf_counter()
+                component.process(message, **interpreter.context)
+                timings[component.name].append(perf_counter() - component_start)
+
+    print("")
+    print("%-34s %10s %10s" % ("component", "p50 ms", "p99 ms"))
+    for component in interpreter.pipeline:
+        latencies = sorted(timings[component.name])
+        print("%-34s %10.3f %10.3f" % (component.name, 1000 * percentile(latencies, 0.50),
+                                       1000 * percentile(latencies, 0.99)))
+
+    start = perf_counter()
+    for _ in range(rounds):
+        for sentence in sentences:
+            interpreter.parse(sentence)
+    single = perf_counter() - start
+
+    start = perf_counter()
+    for _ in range(rounds):
+        parse_batch(interpreter, sentences)
+    batched = perf_counter() - start
+
+    total = rounds * len(sentences)
+    print("")
+    print("parse:       %10.0f sentences/s" % (total / single))
+    print("parse_batch: %10.0f sentences/s" % (total / batched))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="AgentModel benchmarks")
+    parser.add_argument("--only", default=",".join(BENCHMARKS),
+                        help="comma separated tables: " + ", ".join(BENCHMARKS))
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--dialogs", type=int, default=20, help="dialogs per user")
+    parser.add_argument("--tasks", type=int, default=10, help="task groups in the synthetic agent")
+    parser.add_argument("--real", metavar="MODEL_DIR",
+                        help="benchmark the stages of a trained RasaNLU model instead")
+    parser.add_argument("--config", default="Agent/config_spacy.json")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.real:
+        bench_pipeline(args.real, args.config, args.rounds)
+        sys.exit(0)
+
+    for name in args.only.split(","):
+        BENCHMARKS[name](args)
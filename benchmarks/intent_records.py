@@ -0,0 +1,68 @@
+# Allocations of recording an intent in set_active_intent, once per
+# getResponse: the old deepcopy of the analyzed text vs an IntentRecord.
+#
+# Run from the repository root:  python -m benchmarks.intent_records
+
+import time
+import timeit
+import tracemalloc
+from copy import deepcopy
+from datetime import datetime
+from structures.sessions import IntentRecord
+
+ROUNDS = 10000
+
+
+def analyzed_text_sample(active=5):
+    ''' An analyzed text as getResponse has it when the intent is set '''
+    return {
+        'intent': {'name': 'Add Event', 'confidence': 0.83},
+        'parameters': {'eventType': 'meeting', 'time': '2017-07-23T17:00:00.000Z',
+                       'action': 'Add', 'people': ['George', 'Chris'],
+                       'context-eventType': 'class'},
+        'text': 'add a meeting with George and Chris at 5pm',
+        'time_created': datetime.now(),
+        'request_num': 4,
+        'active_contexts': ['Event Added'] * active,
+        'active_intents': ['Add Event'] * active,
+    }
+
+
+def record_deepcopy(analyzed_text):
+    intent_content = deepcopy(analyzed_text)
+    intent_content['time_created'] = datetime.now()
+    intent_content['request_num'] = 5
+    return intent_content
+
+
+def record_intent(analyzed_text):
+    return IntentRecord(analyzed_text['intent']['name'], analyzed_text['parameters'], time.time(), 5)
+
+
+def allocations(function, analyzed_text):
+    ''' (bytes, blocks) still allocated by ROUNDS kept recordings '''
+    kept = []
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+
+    for _ in range(ROUNDS):
+        kept.append(function(analyzed_text))
+
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    stats = after.compare_to(before, 'filename')
+    size = sum(stat.size_diff for stat in stats)
+    blocks = sum(stat.count_diff for stat in stats)
+    return size / ROUNDS, blocks / ROUNDS
+
+
+if __name__ == "__main__":
+
+    analyzed_text = analyzed_text_sample()
+
+    print("%-12s %14s %14s %12s" % ("recording", "bytes/call", "blocks/call", "us/call"))
+    for name, function in [("deepcopy", record_deepcopy), ("IntentRecord", record_intent)]:
+        size, blocks = allocations(function, analyzed_text)
+        seconds = timeit.timeit(lambda: function(analyzed_text), number=ROUNDS)
+        print("%-12s %14.0f %14.1f %12.2f" % (name, size, blocks, 1e6 * seconds / ROUNDS))
@@ -0,0 +1,98 @@
+# Pre-fork serving benchmark. The synthetic agent is served by 1..N forked
+# workers, with client threads sending random dialogs. The stub interpreter
+# burns --parse-ms of CPU per sentence, like RasaNLU does under the GIL.
+# The memory column sums the workers' proportional set size (PSS, Linux
+# only), which counts the pages shared copy-on-write only once.
+#
+# Run from the repository root:
+#   python -m benchmarks.prefork
+#   python -m benchmarks.prefork --workers 1,2,4 --ballast-mb 200
+
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from model_handler import AgentModel
+from prefork import PreforkAgent
+from benchmarks.dialogue import synthetic_agent, StubInterpreter
+from benchmarks.concurrency import conversations
+
+
+class BusyStubInterpreter(StubInterpreter):
+    ''' StubInterpreter holding the CPU (and the GIL) for cost seconds per
+        sentence. The ballast stands in for the loaded model's memory '''
+
+    def __init__(self, intent_names, cost, ballast_mb):
+        StubInterpreter.__init__(self, intent_names)
+        self.cost = cost
+        self.ballast = [bytes(1024 * 1024) for _ in range(ballast_mb)]
+
+    def parse(self, text):
+        deadline = perf_counter() + self.cost
+        while perf_counter() < deadline:
+            pass
+        return StubInterpreter.parse(self, text)
+
+
+def proportional_set_size(pid):
+    ''' Bytes, or None where /proc/<pid>/smaps_rollup isn't available '''
+    try:
+        with open("/proc/%d/smaps_rollup" % pid) as smaps:
+            for line in smaps:
+                if line.startswith("Pss:"):
+                    return 1024 * int(line.split()[1])
+    except OSError:
+        return None
+
+
+def run(workers, convs, args):
+    intents, contexts = synthetic_agent(args.tasks)
+
+    def factory():
+        return AgentModel(interpreter=BusyStubInterpreter(intents, args.parse_ms / 1000.0, args.ballast_mb),
+                          intents=intents, contexts=contexts,
+                          fallback_responses=["Could you repeat that?"], parse_cache_size=0)
+
+    pool = PreforkAgent(workers=workers, agent_factory=factory).start()
+    try:
+        def play(user_id):
+            for text in convs[user_id]:
+                pool.getResponse(text, user_id)
+
+        start = perf_counter()
+        with ThreadPoolExecutor(args.clients) as clients:
+            list(clients.map(play, convs))
+        total = perf_counter() - start
+
+        sizes = [proportional_set_size(slot.process.pid) for slot in pool.slots]
+        memory = sum(sizes) if None not in sizes else None
+    finally:
+        pool.close()
+
+    return sum(len(texts) for texts in convs.values()) / total, memory
+
+
+def main(args):
+    convs = conversations(args.users, args.dialogs, args.tasks)
+
+    print("%-10s %12s %10s %14s" % ("workers", "requests/s", "speedup", "workers MB"))
+    base = None
+    for workers in args.workers:
+        throughput, memory = run(workers, convs, args)
+        base = base or throughput
+        print("%-10d %12.0f %10.2f %14s" % (workers, throughput, throughput / base,
+                                              "%.1f" % (memory / 2 ** 20) if memory is not None else "-"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PreforkAgent scaling benchmark")
+    parser.add_argument("--workers", default=",".join(str(workers) for workers in [1, 2, 4, os.cpu_count()]),
+                        type=lambda value: sorted(set(int(workers) for workers in value.split(","))))
+    parser.add_argument("--clients", type=int, default=32, help="client threads")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--dialogs", type=int, default=3, help="dialogs per user")
+    parser.add_argument("--tasks", type=int, default=10, help="task groups in the synthetic agent")
+    parser.add_argument("--parse-ms", type=float, default=1.0, help="CPU time the stub takes per sentence")
+    parser.add_argument("--ballast-mb", type=int, default=100, help="memory the stub model holds")
+    main(parser.parse_args())
@@ -0,0 +1,114 @@
+# Replays a trace recorded with AgentModel.start_trace, at a target rate or as
+# fast as possible, and reports the throughput and latency percentiles.
+#
+# With --parse cached (the default) the recorded RasaNLU output of every
+# sentence is given to getResponse, so only the dialogue engine is measured
+# and no model is loaded. With --parse live the sentences are parsed again
+# by the model in --model. Responses are picked with a seeded RNG, so
+# two replays of the same trace can be diffed with --output.
+#
+# Run from the repository root:
+#   python -m benchmarks.replay trace.jsonl
+#   python -m benchmarks.replay trace.jsonl --qps 200 --output replies.jsonl
+#   python -m benchmarks.replay trace.jsonl --parse live --model Agent/models/model_001
+
+import json
+import time
+import argparse
+from time import perf_counter
+
+from model_handler import AgentModel
+from structures.parse_cache import copy_prediction
+from traces import read_trace
+from serialization import json_default
+from benchmarks.dialogue import percentile
+
+
+class TraceInterpreter():
+    ''' Answers parse() from the recorded parses, by text '''
+
+    def __init__(self, records):
+        self.parses = {record['text']: record['parse'] for record in records}
+
+    def parse(self, text):
+        return copy_prediction(self.parses[text])
+
+
+def make_model(records, args):
+    if args.parse == "cached":
+        return AgentModel(interpreter=TraceInterpreter(records), seed=args.seed,
+                          parse_cache_size=0)
+    return AgentModel(model_dir=args.model, conf_file=args.config, seed=args.seed)
+
+
+def replay(model, records, qps, cached_parse):
+    ''' Sends the records in order, in one thread. With a qps, request i is due
+        at i / qps seconds and its latency is counted from then, so a backlog
+        shows up in the percentiles. Returns (seconds, latencies, responses) '''
+    latencies = []
+    responses = []
+
+    start = perf_counter()
+
+    for position, record in enumerate(records):
+        due = start + position / qps if qps else perf_counter()
+        wait = due - perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+
+        prediction = copy_prediction(record['parse']) if cached_parse else None
+        responses.append(model.getResponse(record['text'], record['user_id'], prediction))
+        latencies.append(perf_counter() - due)
+
+    total = perf_counter() - start
+
+    return total, latencies, responses
+
+
+def report(records, total, latencies, responses):
+    ordered = sorted(latencies)
+    changed = sum(1 for record, response in zip(records, responses)
+                  if record['intent'] != response['intent']['name'])
+
+    print("requests      %10d" % len(records))
+    print("seconds       %10.2f" % total)
+    print("requests/s    %10.0f" % (len(records) / total if total else 0.0))
+    for label, fraction in [("p50", 0.50), ("p90", 0.90), ("p99", 0.99), ("p99.9", 0.999)]:
+        print("%-6s ms     %10.3f" % (label, 1000 * percentile(ordered, fraction)))
+    print("max ms        %10.3f" % (1000 * ordered[-1] if ordered else 0.0))
+    print("other intent  %10d" % changed)
+
+
+def write_responses(path, records, responses):
+    ''' One line per request, stable enough to diff two versions' replays '''
+    with open(path, "w") as output_file:
+        for record, response in zip(records, responses):
+            output_file.write(json.dumps({'user_id': record['user_id'],
+                                          'text': record['text'],
+                                          'intent': response['intent']['name'],
+                                          'response': response.get('response'),
+                                          'active_contexts': list(response.get('active_contexts', ())),
+                                          'active_intents': list(response.get('active_intents', ()))},
+                                         default=json_default, sort_keys=True) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded AgentModel trace")
+    parser.add_argument("trace", help="JSONL file written by AgentModel.start_trace")
+    parser.add_argument("--qps", type=float, default=0, help="target requests/s, 0 for as fast as possible")
+    parser.add_argument("--parse", choices=["cached", "live"], default="cached",
+                        help="use the recorded parses, or parse again with --model")
+    parser.add_argument("--model", default="Agent/models/model_001")
+    parser.add_argument("--config", default="Agent/config_spacy.json")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the responses' RNG")
+    parser.add_argument("--output", help="write the replies as JSONL to this file")
+    args = parser.parse_args()
+
+    records = read_trace(args.trace)
+    model = make_model(records, args)
+
+    total, latencies, responses = replay(model, records, args.qps, args.parse == "cached")
+    report(records, total, latencies, responses)
+
+    if args.output:
+        write_responses(args.output, records, responses)
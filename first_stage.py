@@ -0,0 +1,153 @@
+# FirstStageClassifier:  A cheap classifier tried before the RasaNLU pipeline.
+#                        Built from the model's own training examples, it answers
+#                        the short stock turns ("yes", "no, don't do it", "stop")
+#                        of intents that need no entities, and leaves anything
+#                        it isn't confident about to the full pipeline.
+
+import os
+import re
+import json
+import math
+import zlib
+import threading
+
+# Words are letters/digits, apostrophes are dropped so "don't" == "dont"
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Number of buckets the word n-grams are hashed into
+HASH_BUCKETS = 2 ** 20
+
+# Longer sentences always go through the full pipeline
+MAX_WORDS = 8
+
+
+def normalize_words(text):
+    return WORD_PATTERN.findall(text.lower().replace("'", ""))
+
+
+def hashed_ngrams(words):
+    ''' The hashed word unigrams and bigrams of a sentence '''
+    ngrams = list(words)
+    ngrams.extend(first + " " + second for first, second in zip(words, words[1:]))
+
+    return frozenset(zlib.crc32(ngram.encode("utf-8")) % HASH_BUCKETS for ngram in ngrams)
+
+
+class FirstStageClassifier():
+    ''' Exact lookup of the normalized training sentences, then a nearest
+        neighbour over their hashed n-grams (cosine similarity). A sentence is
+        answered only if the best intent beats every other one by threshold,
+        and is one of the answerable intents. The examples of every intent are
+        indexed, so that they compete with the answerable ones '''
+
+    def __init__(self, examples, answerable, threshold, max_words=MAX_WORDS):
+        # examples: (text, intent name) pairs
+        self.answerable = frozenset(answerable)
+        self.threshold = threshold
+        self.max_words = max_words
+
+        self.exact = {}
+        self.example_intents = []
+        self.example_norms = []
+        self.index = {}
+
+        conflicting = set()
+        for text, intent_name in examples:
+            words = normalize_words(text)
+            if not words:
+                continue
+
+            key = " ".join(words)
+            if self.exact.get(key, intent_name) != intent_name:
+                conflicting.add(key)
+            self.exact[key] = intent_name
+
+            features = hashed_ngrams(words)
+            example_id = len(self.example_intents)
+            self.example_intents.append(intent_name)
+            self.example_norms.append(math.sqrt(len(features)))
+            for feature in features:
+                self.index.setdefault(feature, []).append(example_id)
+
+        # Sentences given for more than one intent are left to the pipeline
+        for key in conflicting:
+            del self.exact[key]
+
+        self.lock = threading.Lock()
+        self.counters = {'tried': 0, 'exact': 0, 'ngrams': 0, 'passed_on': 0}
+
+    @classmethod
+    def from_model_dir(cls, model_dir, intents, threshold):
+        ''' Built from the training_data.json RasaNLU keeps in the model directory.
+            Only intents with no parameters are answered, since the first stage
+            extracts no entities. Information intents are left out as well, their
+            action fills the incomplete intents with the extracted entities.
+            None if the model directory has no training data '''
+        path = os.path.join(model_dir, "training_data.json")
+        if not os.path.isfile(path):
+            return None
+
+        with open(path) as data_file:
+            examples = json.load(data_file)['rasa_nlu_data']['common_examples']
+
+        answerable = [name for name, info in intents.items()
+                      if not info['parameters'] and info['tag'] != 'Information']
+
+        return cls([(example['text'], example['intent']) for example in examples],
+                   answerable, threshold)
+
+    def classify(self, text):
+        ''' A RasaNLU-like parse output, or None if the pipeline should decide '''
+        words = normalize_words(text)
+        if not words or len(words) > self.max_words:
+            return None
+
+        intent_name = self.exact.get(" ".join(words))
+        if intent_name is not None:
+            scores = {intent_name: 1.0}
+            counter = 'exact'
+        else:
+            scores = self.similarities(words)
+            counter = 'ngrams'
+
+        ranking = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        best = ranking[0][1] if ranking else 0.0
+        runner_up = ranking[1][1] if len(ranking) > 1 else 0.0
+
+        with self.lock:
+            self.counters['tried'] += 1
+            if not ranking or best - runner_up < self.threshold or ranking[0][0] not in self.answerable:
+                self.counters['passed_on'] += 1
+                return None
+            self.counters[counter] += 1
+
+        intent_ranking = [{"name": name, "confidence": confidence} for name, confidence in ranking]
+        return {"text": text,
+                "intent": dict(intent_ranking[0]),
+                "intent_ranking": intent_ranking,
+                "entities": []}
+
+    def similarities(self, words):
+        ''' {intent name: cosine similarity of its closest example} '''
+        features = hashed_ngrams(words)
+        overlaps = {}
+        for feature in features:
+            for example_id in self.index.get(feature, ()):
+                overlaps[example_id] = overlaps.get(example_id, 0) + 1
+
+        norm = math.sqrt(len(features))
+        scores = {}
+        for example_id, overlap in overlaps.items():
+            similarity = overlap / (norm * self.example_norms[example_id])
+            intent_name = self.example_intents[example_id]
+            if similarity > scores.get(intent_name, 0.0):
+                scores[intent_name] = similarity
+
+        return scores
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats['short_circuited'] = stats['exact'] + stats['ngrams']
+        stats['threshold'] = self.threshold
+        return stats
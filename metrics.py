@@ -0,0 +1,121 @@
+# StageMetrics:     Latency histograms for the stages of a request
+#                   (parse, reform, filtering, expiry, action, rendering).
+#                   Exposed as a dict snapshot or in the Prometheus text format.
+
+import os
+import bisect
+import threading
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+           0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+METRIC_NAME = "agent_stage_seconds"
+
+
+class Histogram():
+    ''' Per bucket (not cumulative) counts, plus the count and sum of the observations '''
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, fraction):
+        ''' Upper bound of the bucket holding the given quantile '''
+        if not self.count:
+            return 0.0
+
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return BUCKETS[index] if index < len(BUCKETS) else float("inf")
+
+        return float("inf")
+
+
+class StageMetrics():
+    ''' One Histogram per stage name, created on first use '''
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def snapshot(self):
+        ''' {stage: {count, sum_ms, mean_ms, p50_ms, p99_ms}} '''
+        with self.lock:
+            snapshot = {}
+            for stage, histogram in self.histograms.items():
+                snapshot[stage] = {
+                    'count': histogram.count,
+                    'sum_ms': 1000 * histogram.sum,
+                    'mean_ms': 1000 * histogram.sum / histogram.count if histogram.count else 0.0,
+                    'p50_ms': 1000 * histogram.quantile(0.50),
+                    'p99_ms': 1000 * histogram.quantile(0.99),
+                }
+            return snapshot
+
+    def prometheus_text(self):
+        ''' The histograms in the Prometheus text exposition format '''
+        lines = ["# HELP %s Time spent in each stage of a request." % METRIC_NAME,
+                 "# TYPE %s histogram" % METRIC_NAME]
+
+        with self.lock:
+            for stage in sorted(self.histograms):
+                histogram = self.histograms[stage]
+
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append('%s_bucket{stage="%s",le="%s"} %d' % (METRIC_NAME, stage, bound, cumulative))
+
+                lines.append('%s_sum{stage="%s"} %.9f' % (METRIC_NAME, stage, histogram.sum))
+                lines.append('%s_count{stage="%s"} %d' % (METRIC_NAME, stage, histogram.count))
+
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        ''' Write the Prometheus text to a file, e.g. for the node exporter's
+            textfile collector. The file is replaced atomically '''
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as metrics_file:
+            metrics_file.write(self.prometheus_text())
+        os.replace(temp_path, path)
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+
+class MetricsDumper(threading.Thread):
+    ''' Dumps the metrics to a file every interval seconds '''
+
+    def __init__(self, metrics, path, interval=15):
+        threading.Thread.__init__(self, daemon=True)
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.metrics.dump(self.path)
+
+    def stop(self):
+        self.stopped.set()
+        self.metrics.dump(self.path)
@@ -0,0 +1,225 @@
+# MappedArtifacts: Memory-mappable copy of the heavy components of a trained
+#                  model, written next to its metadata.json. The component is
+#                  pickled without its numpy arrays, which go to .npy files
+#                  loaded with mmap_mode='c', and the CRF's crfsuite model is
+#                  written as a plain file the tagger opens. Loading is then
+#                  mostly mapping files, and the workers on a node share the
+#                  arrays' pages through the page cache. Models without an
+#                  up to date export are loaded from their pickles as before.
+#
+# Export a trained model, from the repository root:
+#   python model_artifacts.py Agent/models/model_001
+
+import os
+import json
+import pickle
+import shutil
+import logging
+import argparse
+from time import perf_counter
+
+logger = logging.getLogger(__name__)
+
+MAPPED_DIR = "mapped"
+MANIFEST = "manifest.json"
+FORMAT_VERSION = 1
+
+# Arrays smaller than this stay in the pickle
+MIN_MAPPED_BYTES = 4096
+
+# The components that can be exported
+MAPPED_COMPONENTS = ("intent_classifier_sklearn", "ner_crf")
+
+
+def source_file(component_name, metadata):
+    ''' The pickle RasaNLU loads the component from, relative to the
+        model directory. metadata is the parsed metadata.json '''
+    if component_name == "intent_classifier_sklearn":
+        return metadata.get("intent_classifier_sklearn")
+    if component_name == "ner_crf":
+        return (metadata.get("entity_extractor_crf") or {}).get("model_file")
+    return None
+
+
+def file_stamp(path):
+    ''' Changes whenever the file is rewritten '''
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Pickling with the arrays and model files out of band
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class MappedPickler(pickle.Pickler):
+    ''' Writes the large plain arrays as <prefix>_<n>.npy files and the
+        crfsuite files as <prefix>_<n>.crfsuite, the pickle refers to them '''
+
+    def __init__(self, pickle_file, directory, prefix):
+        pickle.Pickler.__init__(self, pickle_file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.directory = directory
+        self.prefix = prefix
+        self.files = []
+
+    def next_name(self, extension):
+        name = "%s_%d%s" % (self.prefix, len(self.files), extension)
+        self.files.append(name)
+        return name
+
+    def persistent_id(self, obj):
+        import numpy as np
+
+        # Exactly ndarray: subclasses like the masked arrays are pickled as usual
+        if type(obj) is np.ndarray:
+            if obj.dtype.hasobject or obj.nbytes < MIN_MAPPED_BYTES:
+                return None
+            name = self.next_name(".npy")
+            np.save(os.path.join(self.directory, name), np.ascontiguousarray(obj), allow_pickle=False)
+            return ("npy", name)
+
+        # sklearn_crfsuite's handle of the trained crfsuite model
+        if type(obj).__name__ == "FileResource" and getattr(obj, "name", None):
+            name = self.next_name(".crfsuite")
+            shutil.copyfile(obj.name, os.path.join(self.directory, name))
+            return ("crfsuite", name, obj.suffix, obj.prefix)
+
+        return None
+
+
+class MappedUnpickler(pickle.Unpickler):
+
+    def __init__(self, pickle_file, directory):
+        pickle.Unpickler.__init__(self, pickle_file)
+        self.directory = directory
+
+    def persistent_load(self, pid):
+        kind, name = pid[0], pid[1]
+        path = os.path.join(self.directory, name)
+
+        if kind == "npy":
+            import numpy as np
+            # Copy on write: shared with the other processes until written to
+            return np.load(path, mmap_mode="c", allow_pickle=False)
+
+        if kind == "crfsuite":
+            # Not a temporary file, so never deleted by the FileResource
+            from sklearn_crfsuite._fileresource import FileResource
+            return FileResource(filename=path, suffix=pid[2], prefix=pid[3])
+
+        raise pickle.UnpicklingError("Unknown mapped artifact %r" % (pid,))
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Export / load
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def read_metadata(model_dir):
+    with open(os.path.join(model_dir, "metadata.json")) as metadata_file:
+        return json.load(metadata_file)
+
+
+def export_components(model_dir, components):
+    ''' Write the mapped copy of the given {name: component} of the model in
+        model_dir, replacing any previous one. Returns the manifest '''
+    metadata = read_metadata(model_dir)
+    target = os.path.join(model_dir, MAPPED_DIR)
+    temp_target = target + ".tmp"
+
+    shutil.rmtree(temp_target, ignore_errors=True)
+    os.makedirs(temp_target)
+
+    manifest = {'version': FORMAT_VERSION, 'components': {}}
+    for component_name, component in components.items():
+        source = source_file(component_name, metadata)
+        if source is None:
+            raise ValueError("%s can't be exported, it isn't one of %s"
+                             % (component_name, ", ".join(MAPPED_COMPONENTS)))
+
+        pickle_name = component_name + ".pkl"
+        with open(os.path.join(temp_target, pickle_name), "wb") as pickle_file:
+            pickler = MappedPickler(pickle_file, temp_target, component_name)
+            pickler.dump(component)
+
+        manifest['components'][component_name] = {
+            'pickle': pickle_name,
+            'files': pickler.files,
+            'source': source,
+            'source_stamp': file_stamp(os.path.join(model_dir, source))}
+
+    with open(os.path.join(temp_target, MANIFEST), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+
+    shutil.rmtree(target, ignore_errors=True)
+    os.rename(temp_target, target)
+
+    return manifest
+
+
+def export_model(model_dir):
+    ''' Load the mappable components of a trained model
+        from their pickles with RasaNLU, and export them '''
+    from rasa_nlu import components
+    from rasa_nlu.model import Metadata
+
+    metadata = Metadata.load(model_dir)
+    builder = components.ComponentBuilder(use_cache=False)
+
+    loaded = {component_name: builder.load_component(component_name, model_dir, metadata)
+              for component_name in metadata.pipeline if component_name in MAPPED_COMPONENTS}
+
+    return export_components(model_dir, loaded)
+
+
+def read_manifest(model_dir):
+    ''' The manifest of the model's mapped copy, None if there is none '''
+    try:
+        with open(os.path.join(model_dir, MAPPED_DIR, MANIFEST)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+    if manifest.get('version') != FORMAT_VERSION:
+        return None
+    return manifest
+
+
+def load_mapped_component(component_name, model_dir, manifest):
+    ''' The component from the mapped copy, None if it isn't
+        in it or its pickle was retrained since the export '''
+    entry = manifest['components'].get(component_name)
+    if entry is None:
+        return None
+
+    try:
+        stale = file_stamp(os.path.join(model_dir, entry['source'])) != entry['source_stamp']
+    except OSError:
+        stale = False
+    if stale:
+        logger.warning("The mapped %s of %s is older than %s, loading the pickle",
+                       component_name, model_dir, entry['source'])
+        return None
+
+    directory = os.path.join(model_dir, MAPPED_DIR)
+    try:
+        with open(os.path.join(directory, entry['pickle']), "rb") as pickle_file:
+            return MappedUnpickler(pickle_file, directory).load()
+    except (OSError, pickle.UnpicklingError, ImportError, AttributeError):
+        logger.exception("Could not load the mapped %s of %s, loading the pickle",
+                         component_name, model_dir)
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the classifier and CRF of trained models "
+                                                 "to memory-mappable files")
+    parser.add_argument("model_dirs", nargs="+")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    for model_dir in args.model_dirs:
+        start = perf_counter()
+        manifest = export_model(model_dir)
+        for component_name, entry in manifest['components'].items():
+            logger.info("%s: %s, %d mapped files", model_dir, component_name, len(entry['files']))
+        logger.info("%s exported in %.2fs", model_dir, perf_counter() - start)
@@ -1,20 +1,60 @@
 # AgentModel Class:     Provides an interface for the Model
 #                       that is used to analyze the text.
 
-import sys
-import json
+import pickle
 import random
-from copy import deepcopy
-from datetime import datetime, timedelta
-from rasa_nlu.model import Metadata, Interpreter
-from rasa_nlu.config import RasaNLUConfig
-from structures.custom_structs import LastUpdatedOrderedDict
+import time
+import logging
+import threading
+from datetime import datetime
+from structures.sessions import SessionStore, IntentRecord, remove_identical
+from structures.session_db import SQLiteSessionStore
+from structures.checkpoint import write_checkpoint, read_checkpoint, SessionCheckpointer
+from structures.intent_index import IntentIndex
+from structures.templates import compile_templates, check_templates
+from structures.parse_cache import ParseCache, model_fingerprint
+from nlu_pipeline import parse_batch, INTENT_RANKING_LENGTH
+from metrics import StageMetrics, MetricsDumper
+from model_loader import ModelLoader, ModelWatcher, ShadowModel
+from first_stage import FirstStageClassifier
+from traces import TraceRecorder
+from serialization import get_projection, dumps_compact, dumps_pretty
+
+logger = logging.getLogger(__name__)
 
 MODEL_DIR = "Agent/models/linda_001"
 CONFIG_DIR = "Agent/config_spacy.json"
 SIMILARITY_THRESHOLD = 0.1
 INCOMPLETE_INTENTS_LIFESPAN = [3, 8]
 
+# Parse results cache: max entries, seconds to live and
+# seconds between checks for a retrained model directory
+PARSE_CACHE_SIZE = 10000
+PARSE_CACHE_TTL = 3600
+PARSE_CACHE_CHECK_INTERVAL = 5
+
+# How far the first-stage classifier's best intent must lead the runner-up
+# for the sentence to skip the RasaNLU pipeline. None disables the first stage
+FIRST_STAGE_THRESHOLD = 0.5
+
+# Entities reformResult uses no matter what INTENTS declare (PERSON -> 'people')
+REFORM_ENTITIES = ('PERSON',)
+
+# What getResponse returns: 'reply', 'intent' (reply, intent name and
+# confidence) or 'full' (the whole analyzed text, for debugging)
+RESPONSE_MODE = 'full'
+
+# Number of locks the users are spread over. A user's requests are handled
+# one at a time, users on different locks are handled in parallel
+USER_LOCK_STRIPES = 64
+
+# Max number of users kept in memory. Sessions idle for longer than the
+# longest lifespan have nothing active left and are evicted
+MAX_SESSIONS = 1000000
+
+# Seconds between two checkpoints of the sessions, see checkpoint_path
+CHECKPOINT_INTERVAL = 60
+
 
 # Parameters: { eventType : assignment,classes,appointment
 #               time : 2017-07-23T00:00:00:0000Z | from: --
@@ -87,54 +127,25 @@ def reformResult(prediction, request_num):
     return result
 
 
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-
-
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-# Used for substituting $parameter with values from a dict containing the values
-# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-
-def get_parameters_list(sentence):
-    ''' Get list of parameters needed
-        in the response sentense'''
+def needed_entities(intents):
+    ''' The entity types the agent actually uses: the intents' parameters
+        and the ones reformResult turns into parameters itself '''
+    entities = set(REFORM_ENTITIES)
+    for info in intents.values():
+        entities.update(info['parameters'])
 
-    found_parameters = []
-    words = sentence.split(" ")
+    return frozenset(entities)
 
-    for word in words:
-        if word[0] == "$":
-            # Remove fullstop from the param name
-            if word[-1] == ".":
-                word = word[:-1]
-                
-            found_parameters.append(word[1:])
-
-    return found_parameters
-
-
-def replace_parameters_in_response(parameters_dict, needed_parameters, response):
-
-    for needed_param in needed_parameters:
-
-        param_value = parameters_dict[needed_param]
-        if not isinstance(param_value, str):
-            param_value = str(param_value)
-
-        response = response.replace('$'+needed_param, param_value)
-
-    return response
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-def select_sentence(parameters, choices_list):
-    ''' Randomly pick a sentence from a list of sentences
-        and replace values of any parameters'''
-    response = random.choice(choices_list)
-    needed_parameters = get_parameters_list(response)
-    response = replace_parameters_in_response(parameters,needed_parameters,response)
-    return response
+
+def select_sentence(parameters, choices_list, rng=random):
+    ''' Randomly pick a sentence from a list of compiled Templates
+        and replace values of any parameters. A seeded random.Random
+        can be given as rng, for reproducible replies '''
+    return rng.choice(choices_list).render(parameters)
 
 
 def all_parameters_found(intent, analyzed_text):
@@ -154,318 +165,583 @@ class AgentModel():
 
     intents_info = {}
     contexts_info = {}
+    intent_index = None
     fallback_responses = []
-
-    active_contexts = {}
-    active_intents = {}
-    incomplete_intents_stack = {}
-    requests_num = {}
-
-    def __init__(self, sim_thr=SIMILARITY_THRESHOLD, model_dir=MODEL_DIR, conf_file=CONFIG_DIR):
-        # Takes some time,to initialize
-
-        from data.intents import INTENTS
-        self.intents_info = INTENTS
-        from data.contexts import CONTEXTS
-        self.contexts_info = CONTEXTS
-        from data.fallback import RESPONSES
-        self.fallback_responses = RESPONSES
+    fallback_templates = ()
+
+    sessions = None
+
+    def __init__(self, sim_thr=SIMILARITY_THRESHOLD, model_dir=MODEL_DIR, conf_file=CONFIG_DIR,
+                 parse_cache_size=PARSE_CACHE_SIZE, parse_cache_ttl=PARSE_CACHE_TTL,
+                 session_ttl=None, max_sessions=MAX_SESSIONS,
+                 interpreter=None, intents=None, contexts=None, fallback_responses=None,
+                 background_load=False, parallel_load=True, prune_extractors=True,
+                 first_stage_threshold=FIRST_STAGE_THRESHOLD, lock_stripes=USER_LOCK_STRIPES,
+                 seed=None, response_mode=RESPONSE_MODE, ranking_length=INTENT_RANKING_LENGTH,
+                 session_db=None, session_store=None,
+                 checkpoint_path=None, checkpoint_interval=CHECKPOINT_INTERVAL, load_runner=None,
+                 mapped=True):
+        # Takes some time,to initialize. With background_load the model is loaded
+        # in a thread, see wait_until_ready/on_ready for when it can answer.
+        # load_runner(function, args) runs the loading itself, e.g. on a native thread.
+        # With mapped, the components exported by model_artifacts are memory-mapped.
+        # An already loaded (or stub) interpreter and other intents/contexts/fallbacks
+        # than the ones in data/ can be given, e.g. for the benchmarks.
+        # With prune_extractors, extractors whose entities no intent uses aren't loaded.
+        # Stock sentences the first-stage classifier is sure about skip RasaNLU.
+        # A seed makes the picked responses reproducible, e.g. for replays.
+        # response_mode picks how much of the analyzed text getResponse returns.
+        # The classifier ranks the top ranking_length intents, plus those within sim_thr.
+        # With session_db the sessions are also kept in that SQLite file, any other
+        # SessionStore can be given as session_store.
+        # With checkpoint_path the sessions are written to that file every
+        # checkpoint_interval seconds and on close(), and restored from it at start.
+        # Checkpoints are written by the process serving, so use session_db under PreforkAgent
+
+        if intents is None:
+            from data.intents import INTENTS as intents
+        self.intents_info = intents
+        if contexts is None:
+            from data.contexts import CONTEXTS as contexts
+        self.contexts_info = contexts
+        if fallback_responses is None:
+            from data.fallback import RESPONSES as fallback_responses
+        self.fallback_responses = fallback_responses
+
+        # Compile the intents/contexts lookups, fails on unknown names
+        self.intent_index = IntentIndex(intents, contexts)
+        self.fallback_templates = compile_templates(fallback_responses)
+
+        # Responses that would fail when picked
+        for problem in check_templates(self.intent_index, self.fallback_templates):
+            logger.warning(problem)
+
+        # Latency histograms of each stage of the requests
+        self.metrics = StageMetrics()
+        self.metrics_dumper = None
+
+        # Picks the responses, and the optional trace of the requests
+        self.rng = random.Random(seed)
+        self.trace = None
+        self.response_mode = response_mode
+        self.project = get_projection(response_mode)
 
         self.similarity_threshold = sim_thr
+        self.ranking_length = ranking_length
+        self.needed_entities = needed_entities(intents) if prune_extractors else None
+        self.mapped = mapped
+
+        # By default a session is kept for as long as the longest lifespan (minutes)
+        if session_ttl is None:
+            lifespans = [info['lifespan'][0] for info in list(intents.values()) + list(contexts.values())]
+            session_ttl = 60 * max(lifespans + [1])
+        if session_store is not None:
+            self.sessions = session_store
+        elif session_db is not None:
+            self.sessions = SQLiteSessionStore(session_db, session_ttl, max_sessions, self.intent_index)
+        else:
+            self.sessions = SessionStore(session_ttl, max_sessions)
+
+        # Striped per-user locks, getResponse can be called from many threads
+        self.user_locks = [threading.Lock() for _ in range(max(1, lock_stripes))]
+
+        # Sessions of the previous run, and the periodic checkpoints
+        self.checkpoint_path = checkpoint_path
+        self.checkpointer = None
+        if checkpoint_path is not None:
+            self.restore_sessions(checkpoint_path)
+            self.checkpointer = SessionCheckpointer(self, checkpoint_interval)
+            self.checkpointer.start()
+
+        self.model_dir = model_dir
+        self.conf_file = conf_file
+        self.parse_cache = ParseCache(parse_cache_size, parse_cache_ttl)
+        self.parse_cache.bind(model_fingerprint(model_dir))
+        self.parse_cache_checked = time.time()
+
+        # Hot reloading: the number of interpreter swaps so far,
+        # the model directory watcher and the shadow model, if any
+        self.model_generation = 0
+        self.reload_lock = threading.Lock()
+        self.model_watcher = None
+        self.shadow = None
+
+        # Cheap classifier tried before the pipeline, built with each model
+        self.first_stage_threshold = first_stage_threshold
+        self.first_stage = None
+
+        # Readiness of the interpreter
+        self.ready = threading.Event()
+        self.ready_lock = threading.Lock()
+        self.ready_callbacks = []
+        self.load_error = None
+        self.startup_timings = {}
+
+        if interpreter is not None:
+            self.modelInterpreter = interpreter
+            self.set_ready()
+        elif background_load:
+            threading.Thread(target=self.load_model, args=(model_dir, conf_file, parallel_load, load_runner),
+                             name="model-loader", daemon=True).start()
+        else:
+            self.load_model(model_dir, conf_file, parallel_load)
 
-        print("Initializing the model...")
+    def load_model(self, model_dir, conf_file, parallel_load=True, load_runner=None):
+        ''' Load the components of the model, warm the pipeline up and
+            mark the model as ready. The time of each step is kept
+            in startup_timings '''
+        logger.info("Initializing the model...")
 
-        metadata = Metadata.load(model_dir)
-        interpreter = Interpreter.load(metadata, RasaNLUConfig(conf_file))
+        try:
+            if load_runner is None:
+                loader, interpreter = self.load_interpreter(model_dir, conf_file, parallel_load)
+            else:
+                loader, interpreter = load_runner(self.load_interpreter, (model_dir, conf_file, parallel_load))
+        except Exception as error:
+            self.load_error = error
+            logger.exception("Loading the model from %s failed", model_dir)
+            # Wake up whoever waits for the model, they will get the error
+            self.ready.set()
+            raise
+
+        loader.log_timings()
+        self.startup_timings = loader.timings
+        self.first_stage = self.build_first_stage(model_dir)
+        self.modelInterpreter = interpreter
+        self.set_ready()
+
+    def load_interpreter(self, model_dir, conf_file, parallel_load=True):
+        ''' The loaded and warmed up interpreter, with its ModelLoader '''
+        loader = ModelLoader(model_dir, conf_file, parallel_load, self.needed_entities, self.mapped)
+        interpreter = loader.load()
+        loader.warm_up(interpreter)
+        return loader, interpreter
+
+    def build_first_stage(self, model_dir):
+        ''' The first-stage classifier for the model in model_dir, None if
+            it is disabled or the model has no training data to build it from '''
+        if self.first_stage_threshold is None:
+            return None
+
+        return FirstStageClassifier.from_model_dir(model_dir, self.intents_info,
+                                                   self.first_stage_threshold)
+
+    def set_ready(self):
+        with self.ready_lock:
+            self.ready.set()
+            callbacks, self.ready_callbacks = self.ready_callbacks, []
+
+        logger.info("Ready")
+        for callback in callbacks:
+            callback(self)
+
+    def is_ready(self):
+        return self.ready.is_set() and self.load_error is None
+
+    def wait_until_ready(self, timeout=None):
+        ''' Blocks until the model is loaded. Returns False on timeout '''
+        if not self.ready.wait(timeout):
+            return False
+        if self.load_error is not None:
+            raise RuntimeError("The model failed to load: %s" % self.load_error)
+        return True
+
+    def on_ready(self, callback):
+        ''' callback(model) is called once the model is ready,
+            right away if it already is '''
+        with self.ready_lock:
+            if not self.ready.is_set():
+                self.ready_callbacks.append(callback)
+                return
+
+        if self.load_error is None:
+            callback(self)
+
+    def reload_model(self, model_dir, conf_file=None, block=False):
+        ''' Load the model in model_dir in the background and swap it in once it
+            has loaded and warmed up. Sessions are kept, requests already
+            parsing keep the old interpreter. Returns None if a reload is
+            already in progress and, with block, False if the new model failed '''
+        if conf_file is None:
+            conf_file = self.conf_file
+
+        if not self.reload_lock.acquire(blocking=False):
+            logger.warning("A model reload is already in progress, %s is skipped", model_dir)
+            return None
+
+        if not block:
+            threading.Thread(target=self.reload_in_background, args=(model_dir, conf_file),
+                             name="model-reload", daemon=True).start()
+            return True
 
-        print("Ready")
-        print("")
+        return self.reload_in_background(model_dir, conf_file)
+
+    def reload_in_background(self, model_dir, conf_file):
+        ''' Called with the reload_lock held, released once the new model
+            is swapped in, so that a later reload can't be overtaken '''
+        try:
+            loader = ModelLoader(model_dir, conf_file, needed_entities=self.needed_entities,
+                                 mapped=self.mapped)
+            interpreter = loader.load()
+            loader.warm_up(interpreter)
+            first_stage = self.build_first_stage(model_dir)
+        except Exception:
+            logger.exception("Reloading the model from %s failed, keeping %s", model_dir, self.model_dir)
+            self.reload_lock.release()
+            return False
 
+        try:
+            loader.log_timings()
+            self.swap_interpreter(interpreter, model_dir, conf_file, first_stage)
+            self.startup_timings = loader.timings
+        finally:
+            self.reload_lock.release()
+        return True
+
+    def swap_interpreter(self, interpreter, model_dir, conf_file=None, first_stage=None):
+        ''' Atomically start serving with another loaded interpreter '''
+        self.first_stage = first_stage
         self.modelInterpreter = interpreter
-
-    def get_intent_classification(self, input_text, user_id):
+        self.model_dir = model_dir
+        if conf_file is not None:
+            self.conf_file = conf_file
+        self.model_generation += 1
+
+        # The cached results belong to the previous model
+        self.parse_cache.bind(model_fingerprint(model_dir))
+        self.parse_cache_checked = time.time()
+
+        logger.info("Serving the model from %s", model_dir)
+
+    def watch_models(self, models_root, interval=10):
+        ''' Hot-reload whenever a newer trained model appears in models_root '''
+        if self.model_watcher is None:
+            self.model_watcher = ModelWatcher(self, models_root, interval)
+            self.model_watcher.start()
+
+    def start_shadow(self, model_dir, fraction=0.1, conf_file=None):
+        ''' Load a candidate model next to the serving one. A sampled fraction
+            of the parsed sentences is parsed by it as well, off the request
+            path, and shadow_stats() reports how often the intents agree '''
+        loader = ModelLoader(model_dir, conf_file or self.conf_file, needed_entities=self.needed_entities,
+                             mapped=self.mapped)
+        interpreter = loader.load()
+        loader.warm_up(interpreter)
+
+        self.stop_shadow()
+        self.shadow = ShadowModel(interpreter, model_dir, fraction)
+
+    def shadow_stats(self):
+        if self.shadow is None:
+            return None
+        return self.shadow.stats()
+
+    def promote_shadow(self):
+        ''' Serve the shadow model, e.g. once its agreement looks good '''
+        shadow = self.shadow
+        if shadow is not None:
+            self.stop_shadow()
+            self.swap_interpreter(shadow.interpreter, shadow.model_dir,
+                                  first_stage=self.build_first_stage(shadow.model_dir))
+
+    def stop_shadow(self):
+        shadow, self.shadow = self.shadow, None
+        if shadow is not None:
+            shadow.close()
+
+    def parse_texts(self, texts):
+        ''' Parse sentences with RasaNLU. Results of sentences seen before
+            come from the parse cache, stock sentences from the first-stage
+            classifier, the rest are parsed as one batch '''
+
+        # Every few seconds make sure the model directory wasn't retrained
+        now = time.time()
+        if now - self.parse_cache_checked > PARSE_CACHE_CHECK_INTERVAL:
+            self.parse_cache.bind(model_fingerprint(self.model_dir))
+            self.parse_cache_checked = now
+
+        predictions = [self.parse_cache.get(text) for text in texts]
+        missing = [index for index, prediction in enumerate(predictions) if prediction is None]
+
+        if missing and not self.ready.is_set():
+            self.wait_until_ready()
+
+        first_stage = self.first_stage
+        if missing and first_stage is not None:
+            start = time.perf_counter()
+            for index in missing:
+                predictions[index] = first_stage.classify(texts[index])
+            self.metrics.observe('first_stage', time.perf_counter() - start)
+
+            missing = [index for index in missing if predictions[index] is None]
+
+        if missing:
+            # In-flight requests keep the interpreter they started with,
+            # even if a reload swaps in a new one meanwhile
+            interpreter = self.modelInterpreter
+            generation = self.model_generation
+            missing_texts = [texts[index] for index in missing]
+
+            start = time.perf_counter()
+            parsed = parse_batch(interpreter, missing_texts, ranking_length=self.ranking_length,
+                                 ranking_threshold=self.similarity_threshold)
+            self.metrics.observe('parse', time.perf_counter() - start)
+
+            # Results of a model that was swapped out meanwhile aren't cached
+            cacheable = generation == self.model_generation
+            for index, prediction in zip(missing, parsed):
+                if cacheable:
+                    self.parse_cache.put(texts[index], prediction)
+                predictions[index] = prediction
+
+            shadow = self.shadow
+            if shadow is not None:
+                shadow.sample(missing_texts, parsed)
+
+        return predictions
+
+    def get_intent_classification(self, input_text, user_id, prediction=None):
         ''' This is the part were RasaNLU is used. After getting the results from
-            RasaModel the filtering of the parameters/entities/intents is done here '''
+            RasaModel the filtering of the parameters/entities/intents is done here.
+            If the text was already parsed (batches) its prediction can be given '''
+
+        if prediction is None:
+            prediction = self.parse_texts([input_text])[0]
 
-        result = self.modelInterpreter.parse(input_text)
-        result = reformResult(result, self.requests_num[user_id])
+        start = time.perf_counter()
+        result = reformResult(prediction, self.sessions[user_id].requests_num)
+        self.metrics.observe('reform', time.perf_counter() - start)
 
         ''' If there are intents similar to the one predicted,
             then chose the intent that is not out of context '''
 
+        start = time.perf_counter()
         intent_ranking = result['intent_ranking']
-        highest_confidence = intent_ranking[0]['confidence']
 
-        print([x['name'] for x in intent_ranking])
-        print([x['confidence'] for x in intent_ranking])
-        print("")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("intent ranking user=%s text=%r ranking=%s", user_id, result['text'],
+                         [(x['name'], float(x['confidence'])) for x in intent_ranking])
 
         # No need any more for intent ranking
         del result['intent_ranking']
 
+        intent = self.pick_in_context_intent(intent_ranking, user_id)
+        # If all the intents were out of context just keep the default prediction
+        if intent is not None:
+            result['intent'] = intent
+
+        self.metrics.observe('context_filtering', time.perf_counter() - start)
+        return result
+
+    def pick_in_context_intent(self, intent_ranking, user_id):
+        ''' Out of the intents ranked close to the best one, returns the one
+            that fits the active contexts/intents. None if none of them does '''
+
+        highest_confidence = intent_ranking[0]['confidence']
+
         # Get list of active Contexts in order of insertion
-        active_contexts = [x[0] for x in self.get_active_contexts(user_id)]
+        active_contexts = self.get_active_context_names(user_id)
 
         # Get list of active Intents in order of insertion
         active_intents = self.get_active_intents(user_id)
 
         # Keep only the intents rated really close
         similar_intents = [intent for intent in intent_ranking \
-                                  if (highest_confidence - intent['confidence']) <= SIMILARITY_THRESHOLD]
+                                  if (highest_confidence - intent['confidence']) <= self.similarity_threshold]
+        similar_names = {intent['name'] for intent in similar_intents}
         filtered_intents = []
+        filtered_names = set()
 
         # Check if Intext is in-context with an active context
         for context in active_contexts:
 
-            # Loop through the close Intents that were predicted and filtering
-            # out those that are out of context
-            for intent in similar_intents:
-
-                intent_data = self.intents_info[intent['name']]
-                # Keep intents that are in context and by order of context
-                # Intents in context with recent contexts are prioritized firstly
-                if 'context_needed' not in intent_data \
-                   or not intent_data['context_needed'] \
-                   or context in intent_data['context_needed']:
+            # The close Intents that are in context and not kept yet
+            in_context = (similar_names & self.intent_index.intents_in_context(context)) - filtered_names
+            if not in_context:
+                continue
 
+            # Keep intents that are in context and by order of context
+            # Intents in context with recent contexts are prioritized firstly
+            for intent in similar_intents:
+                if intent['name'] in in_context:
                     filtered_intents.append(intent)
+            filtered_names |= in_context
 
         # Pick the first intent that is a Follow-Up or Information (and there is an incomplete intent)
         for active_intent in active_intents:
 
-            for intent in filtered_intents:
-
-                intent_data = self.intents_info[intent['name']]
-                if 'follow_up' not in intent_data:
-                    pass
-                elif active_intent in intent_data['follow_up'] \
-                    or ((intent['name'] == Information or intent['name'] == 'Cancel') \
-                        and ' - Parameters' in active_intent):
+            follow_ups = self.intent_index.follow_ups_of(active_intent)
+            if follow_ups.isdisjoint(filtered_names):
+                continue
 
-                    result['intent'] = intent
-                    return result
+            for intent in filtered_intents:
+                if intent['name'] in follow_ups:
+                    return intent
 
         # If all the intents were out of place, then return the first in-context
         if filtered_intents:
-            result['intent'] = filtered_intents[0]
+            return filtered_intents[0]
 
-        # If alse all the intents were out of context just return the default prediction
-        return result
+        return None
 
     def check_entries_and_request_num(self, user_id):
-        ''' Misleading name, checks if the needed dicts have entries
+        ''' Misleading name, makes sure there is a session
             for the given user_id. Also handles the request_num '''
 
-        # Check if the required entries for specific user_id exists in dicts
-        if user_id not in self.requests_num:
-            self.requests_num[user_id] = 0
-        if user_id not in self.active_contexts:
-            self.active_contexts[user_id] = LastUpdatedOrderedDict()
-        if user_id not in self.active_intents:
-            self.active_intents[user_id] = []
-        if user_id not in self.incomplete_intents_stack:
-            self.incomplete_intents_stack[user_id] = []
+        # Get the user's session, a new one is created if needed
+        session = self.sessions.get_or_create(user_id)
 
         # If there are no active contexts and intents then reset the requests_num counter
-        if not self.active_contexts[user_id] and not self.active_intents[user_id]:
-            self.requests_num[user_id] = 0
+        if not session.contexts and not session.intents:
+            session.requests_num = 0
+            session.expiry.clear()
 
         # Increase the requests_num counnter
-        self.requests_num[user_id] += 1
+        session.requests_num += 1
 
     def set_active_context(self, context_name, context_content, user_id):
         ''' This is function determines how a new context is set
             when an intent has all its parameters'''
 
+        session = self.sessions[user_id]
+        now = time.time()
+
         # Update the time the context is set, for its lifespan
-        context_content['time_created'] = datetime.now()
-        context_content['request_num'] = self.requests_num[user_id]
+        context_content['time_created'] = datetime.fromtimestamp(now)
+        context_content['request_num'] = session.requests_num
+
+        session.contexts[context_name] = context_content
 
-        self.active_contexts[user_id][context_name] = context_content
+        # Schedule its removal when its lifespan ends
+        lifespan = self.contexts_info[context_name]['lifespan']
+        session.expiry.push(('context', context_name, context_content),
+                            now + 60 * lifespan[0], session.requests_num + lifespan[1])
 
-        # Since a new context was added, update the "active_contexts" entry
-        self.assign_active_contexts(user_id)
+        # Since a new context was added, the active contexts view changed
+        session.invalidate_view()
 
     def get_active_contexts(self, user_id):
         ''' Get a list of tuples (context_name, context_content)
             with the currently active contexts. Last add context will
             be first on the list
             [)"Add-Intent", { })]'''
-        return list(reversed(self.active_contexts[user_id].items()))
+        return list(reversed(self.sessions[user_id].contexts.items()))
 
     def set_active_intent(self, intent_content_original, user_id, incomplete=False):
         ''' Sets an intent. The intent can be both incomplete or complete'''
 
-        intent_content = deepcopy(intent_content_original)
-        # Update the time the intent is set, for its lifespan
-        intent_content['time_created'] = datetime.now()
-        intent_content['request_num'] = self.requests_num[user_id]
+        session = self.sessions[user_id]
+        now = time.time()
+
+        intent_name = intent_content_original['intent']['name']
+        intent = self.intent_index[intent_name]
+
+        lifespan = intent['lifespan']
+        time_deadline = now + 60 * lifespan[0]
+        request_deadline = session.requests_num + lifespan[1]
 
         # If incomplete
         if incomplete:
-            # Add the incomplete intent to both active intents and to the IIS
-            #intent_content['intent']['name'] += ' - Parameters'
-            self.active_intents[user_id].insert(0, intent_content)
-            self.active_intents[user_id][0]['intent']['name'] += ' - Parameters'
-
-            # Update the IIS
-            self.incomplete_intents_stack[user_id].insert(0, intent_content_original)
+            # Update the IIS. The request gets its own dict and parameters, so filling
+            # it later doesn't change the response already returned for this text
+            request = dict(intent_content_original)
+            request['parameters'] = dict(intent_content_original['parameters'])
+            pending = session.iis.push(request, intent)
+
+            # Add the incomplete intent to the active intents, linked to its request
+            # so that when the intent expires its request leaves the IIS as well
+            record = IntentRecord(intent_name + ' - Parameters', intent_content_original['parameters'],
+                                  now, session.requests_num, pending)
+            session.intents.insert(0, record)
+            pending.record = record
+            pending.expiry = session.expiry.push(('intent', record), time_deadline, request_deadline)
         else:
             # If it is complete just add it to the intents list
-            if intent_content['intent']['name'] != "Information" \
-                and intent_content['intent']['name'] != 'Cancel':
+            if not intent.is_information and not intent.is_cancel:
 
-                self.active_intents[user_id].insert(0, intent_content)
+                record = IntentRecord(intent_name, intent_content_original['parameters'],
+                                      now, session.requests_num)
+                session.intents.insert(0, record)
+                session.expiry.push(('intent', record), time_deadline, request_deadline)
 
-        # Update the active intents entry in all active intents/contexts
-        self.assign_active_intents(user_id)
+        # The active intents view changed
+        session.invalidate_view()
 
     def get_active_intents(self, user_id):
+        ''' Names of the active intents, most recent first. The tuple
+            is the session's shared view, it must not be edited '''
+        return self.sessions[user_id].get_view().intents
 
-        return [intent['intent']['name'] for intent in self.active_intents[user_id]]
-
-    def assign_active_contexts(self, user_id):
-        ''' Updates the "active_contexts" entry in all active contexts '''
-        active_contexts = list(self.active_contexts[user_id].keys())
-
-        for context in self.active_contexts[user_id]:
-            self.active_contexts[user_id][context]["active_contexts"] = active_contexts
-
-        for intent in range(len(self.active_intents[user_id])):
-            self.active_intents[user_id][intent]["active_contexts"] = active_contexts
-
-    def assign_active_intents(self, user_id):
-        ''' Updates the "active_intents" entry in all active intents/contexts'''
-        active_intents = self.get_active_intents(user_id)
-
-        for context in self.active_contexts[user_id]:
-            self.active_contexts[user_id][context]["active_intents"] = active_intents
-
-        for intent in range(len(self.active_intents[user_id])):
-            self.active_intents[user_id][intent]['active_intents'] = active_intents
+    def get_active_context_names(self, user_id):
+        ''' Names of the active contexts, most recent first. The tuple
+            is the session's shared view, it must not be edited '''
+        return self.sessions[user_id].get_view().contexts
 
     def assign_context_parameters(self, prediction, user_id):
         ''' Put the 'context_parameters' entry on the prediction
             which holds the parameters of the intent's needed context
             (the one the intent is applied to)'''
 
-        intent = self.intents_info[prediction['intent']['name']]
+        intent = self.intent_index[prediction['intent']['name']]
 
         # Put the needed context's parameters to the intent
-        if 'context_needed' in intent:
+        if intent.context_needed:
 
             for context in self.get_active_contexts(user_id):
-                if context[0] in intent['context_needed']:
+                if context[0] in intent.context_needed:
                     for parameter in context[1]['parameters']:
                         prediction['parameters']['context-'+parameter] = context[1]['parameters'][parameter]
 
         # Put the needed intent's parameters to the intent
-        if 'follow_up' in intent:
+        if intent.follow_up:
 
-            for intent_index, intent_content in enumerate(self.active_intents[user_id]):
-                if intent_content['intent']['name'] in intent['follow_up']:
-                    for parameter in intent_content['parameters']:
-                        prediction['parameters']['intent-'+parameter] = intent_content['parameters'][parameter]
+            for record in self.sessions[user_id].intents:
+                if record.name in intent.follow_up:
+                    for parameter in record.parameters:
+                        prediction['parameters']['intent-'+parameter] = record.parameters[parameter]
 
         return prediction
 
-    def update_active_contexts(self, user_id):
-        ''' Updates the Currently Active Contexts '''
-
-        # list() is used because elements of dict are deleted through iterations
-        for context in list(self.active_contexts[user_id]):
-
-            now = datetime.now()
-
-            lifespan = self.contexts_info[context]['lifespan']
-
-            # Python showing nested dict's datetime as str
-            context_time_created = datetime.strptime(self.active_contexts[user_id][context]['time_created'], "%Y-%m-%d %H:%M:%S")
-
-            time_condition = datetime.now() - context_time_created <= timedelta(minutes=lifespan[0])
-            request_condition = self.requests_num[user_id] - self.active_contexts[user_id][context]['request_num'] < lifespan[1]
-
-            # If one of the two condition is False then remove the given context
-            if not (time_condition and request_condition):
-                del self.active_contexts[user_id][context]
+    def update_active_entries(self, user_id):
+        ''' Removes the expired Contexts and Intents, keeping the IIS up to date.
+            The deadlines were set when each entry was added, so only the
+            entries that actually expired are visited '''
+        self.sessions[user_id].expire(time.time())
 
-            # Correct the active contexts entry in all active contexts
-            self.assign_active_contexts(user_id)
+    def remove_pending(self, pending, user_id):
+        ''' Remove a request from the IIS, along with its "Intent - Parameters"
+            active intent, and cancel the intent's expiry '''
+        session = self.sessions[user_id]
 
-            # If there are no active contexts then reset the requests_num counter
-            if not self.active_contexts[user_id]:
-                self.requests_num[user_id] = 1
-
-    def update_active_intents(self, user_id):
-        ''' Updates the active intents and keeps the IIS up to date '''
-
-        for intent_index, intent in enumerate(self.active_intents[user_id]):
-
-            incomplete_intent = False
-
-            # Get intent name, if it is an incomplete intent fix its name
-            intent_name = intent['intent']['name']
-            if ' - Parameters' in intent_name:
-                intent_name = intent_name[:-13]
-                incomplete_intent = True
-
-            now = datetime.now()
-            lifespan = self.intents_info[intent_name]['lifespan']
-
-            #intent_time_created = datetime.strptime(intent['time_created'], "%Y-%m-%d %H:%M:%S")
-            intent_time_created = intent['time_created']
-
-            time_condition = datetime.now() - intent_time_created <= timedelta(minutes=lifespan[0])
-            request_condition = self.requests_num[user_id] - intent['request_num'] < lifespan[1]
-
-            # If one of the two condition is False then remove the given context
-            if not (time_condition and request_condition):
-                del self.active_intents[user_id][intent_index]
-
-                # If it was an incomplete intent, then remove it from the IIS
-                if incomplete_intent:
-                    # Always the last entry will be the most ancient
-                    del self.incomplete_intents_stack[user_id][-1]
-
-                # Re-assign the active intents entry to all active intents
-                self.assign_active_intents(user_id)
+        session.iis.remove(pending)
+        remove_identical(session.intents, pending.record)
+        session.expiry.cancel(pending.expiry)
+        session.invalidate_view()
 
     def out_of_context(self, intent, user_id):
-        ''' Returns True if given intent IS OUT of Context'''
-        if intent['tag'] == 'Information' or intent['tag'] == 'Cancel':
+        ''' Returns True if given (compiled) intent IS OUT of Context'''
+        if intent.is_information or intent.is_cancel:
             # Information/Cancel Intent is out of Context if there are no elements in IIS
-            if not self.incomplete_intents_stack[user_id]:
+            if not self.sessions[user_id].iis:
                 return True
             return False
 
         else:
             # If intent has no needed contexts then it is in context
-            if 'context_needed' not in intent or not intent['context_needed']:
+            if intent.context_free:
                 return False
 
-            for needed_context in intent['context_needed']:
-                if needed_context in self.active_contexts[user_id]:
-                    return False
-
-            return True
+            return intent.context_needed.isdisjoint(self.sessions[user_id].contexts)
 
     def out_of_place_intent(self, intent, user_id):
-        ''' Returns True if given intent name is out of context, or
+        ''' Returns True if given (compiled) intent is out of context, or
             it is a Follow-Up Intent and the require intent is not present'''
 
         if self.out_of_context(intent, user_id):
             return True
 
-        # Loop through the possigle required intents for follow up
-        if 'follow_up' not in intent:
-            return False
-
-        for intent_needed in intent['follow_up']:
-
-            if intent_needed not in self.get_active_intents(user_id):
-                return True
-
-        return False
+        # All the intents it follows up must be active
+        return not intent.follow_up.issubset(self.get_active_intents(user_id))
 
     def apply_intent_action(self, intent, analyzed_text, user_id):
         ''' This is the part were the 'fullfillment is happening.
@@ -474,16 +750,9 @@ class AgentModel():
 
         # Cancel Action is embeded with the core logic. Not advised to edit this code
         if intent['tag'] == 'Cancel':
-            # Remove the first entry (most recent incomplete intent) from IIS
-            intent_name = self.incomplete_intents_stack[user_id][0]['intent']['name']
-            del self.incomplete_intents_stack[user_id][0]
-
-            # Also remove it from the current active intents
-            for intent_index, intent_data in enumerate(self.active_intents[user_id]):
-                intent_name = intent_data['intent']['name']
-
-                if ' - Parameters' in intent_name:
-                    del self.active_intents[user_id][intent_index]
+            # Remove the first entry (most recent incomplete intent) from IIS,
+            # along with its "Intent - Parameters" active intent
+            self.remove_pending(self.sessions[user_id].iis.top(), user_id)
 
             # Fix the 'active_intents' entry
             #analyzed_text['active_contexts'] = [x[0] for x in list(self.get_active_contexts(user_id))]
@@ -491,46 +760,23 @@ class AgentModel():
 
         # Information Action is embeded with the core logic. Not advised to edit this code
         if intent['tag'] == 'Information':
+            iis = self.sessions[user_id].iis
 
-            # Loop through IIS and get the first entry that has a missing parameter given in Information Intent
-            request_index = 0
-
-            for request in self.incomplete_intents_stack[user_id]:
-                for parameter in analyzed_text['parameters']:
-                    if parameter not in request['parameters']:
-                        # Get the request's index
-                        request_index = self.incomplete_intents_stack[user_id].index(request)
-                        break
+            # The most recent entry of the IIS missing a parameter given in the Information Intent
+            # *If Information Intent is processed that means IIS is not empty (Else Info would be out of context)
+            pending = iis.most_recent_missing(analyzed_text['parameters'])
+            if pending is None:
+                pending = iis.top()
 
-            # Fill missing parameters given from the Information Intent
-            for parameter in analyzed_text['parameters']:
-                if parameter not in self.incomplete_intents_stack[user_id][request_index]['parameters']:
-                    self.incomplete_intents_stack[user_id][request_index]['parameters'][parameter] = analyzed_text['parameters'][parameter]
+            # Fill missing parameters given from the Information Intent. Only this
+            # request changed, so it is the only one that can have been completed
+            if iis.fill(pending, analyzed_text['parameters']) == 0:
 
-            # Check the IIS to see if there is a request that has now all its needed parameters
-            request_index = -1
-
-            for request in self.incomplete_intents_stack[user_id]:
-                incomplete_intent = self.intents_info[request['intent']['name']]
-                if all_parameters_found(incomplete_intent, request):
-                    request_index = self.incomplete_intents_stack[user_id].index(request)
-                    break
-
-            # Found a completed Intent
-            if request_index != -1:
-
-                ready_request = self.incomplete_intents_stack[user_id][request_index]
-                new_intent = self.intents_info[ready_request['intent']['name']]
+                ready_request = pending.request
+                new_intent = pending.intent
 
                 # Remove the request from the IIS and clear the "Intent - Parameters" context
-                del self.incomplete_intents_stack[user_id][request_index]
-
-                # Also remove it from the current active intents
-                for intent_index, intent in enumerate(self.active_intents[user_id]):
-                    intent_name = intent['intent']['name']
-
-                    if ' - Parameters' in intent_name:
-                        del self.active_intents[user_id][intent_index]
+                self.remove_pending(pending, user_id)
 
                 # Set the context
                 if 'context_set' in new_intent:
@@ -544,7 +790,7 @@ class AgentModel():
 
                 # Add the Information Intents' info to the completed Intent
                 ready_request['information_intent'] = analyzed_text['intent']
-                ready_request['active_contexts'] = [context[0] for context in list(self.get_active_contexts(user_id))]
+                ready_request['active_contexts'] = self.get_active_context_names(user_id)
                 ready_request['active_intents'] = self.get_active_intents(user_id)
 
                 # Get the response for the completed Intent
@@ -553,17 +799,11 @@ class AgentModel():
 
             # All the Intents still need some parameters
             else:
-                # Pick the most recent incomplete request
-                # *If Information Intent is processed that means IIS is not empty (Else Info would be out of context)
-
-                request = self.incomplete_intents_stack[user_id][0]
-                new_intent = self.intents_info[request['intent']['name']]
-
-                for parameter in new_intent['parameters']:
-                    if parameter not in request['parameters']:
-                        analyzed_text['response'] = select_sentence(request['parameters'],
-                                                                    new_intent['persistence_responses'][parameter])
-                        break
+                # Ask the most recent incomplete request for its next missing parameter
+                pending = iis.top()
+                parameter = pending.first_missing()
+                analyzed_text['response'] = self.render(pending.request['parameters'],
+                                                       pending.intent.persistence_responses[parameter])
 
         return analyzed_text
 
@@ -574,31 +814,69 @@ class AgentModel():
             # The response was loaded from the Intent Action function
             response = analyzed_text['response']
         else:
-            response = select_sentence(analyzed_text['parameters'], intent['response'])
+            response = self.render(analyzed_text['parameters'], intent.responses)
+
+        return response
 
+    def render(self, parameters, templates):
+        ''' select_sentence, timed as the rendering stage '''
+        start = time.perf_counter()
+        response = select_sentence(parameters, templates, self.rng)
+        self.metrics.observe('rendering', time.perf_counter() - start)
         return response
 
-    def getResponse(self, input_text, user_id='kimonas'):
+    def user_lock(self, user_id):
+        return self.user_locks[hash(user_id) % len(self.user_locks)]
+
+    def getResponse(self, input_text, user_id='kimonas', prediction=None, mode=None):
+        ''' Safe to call from many threads. The sentence is parsed first,
+            outside of any lock, then the user's session is updated while
+            holding the user's lock. The analyzed text is projected with
+            mode, the model's response_mode by default '''
+
+        start = time.perf_counter()
+        if prediction is None:
+            prediction = self.parse_texts([input_text])[0]
+
+        with self.user_lock(user_id):
+            analyzed_text = self.handle_request(input_text, user_id, prediction)
+            self.sessions.save(user_id)
+        self.metrics.observe('total', time.perf_counter() - start)
+
+        trace = self.trace
+        if trace is not None:
+            trace.record(user_id, input_text, prediction, analyzed_text)
+
+        project = self.project if mode is None else get_projection(mode)
+        return project(analyzed_text)
+
+    def getResponseJSON(self, input_text, user_id='kimonas', prediction=None, mode=None):
+        ''' getResponse, serialized as compact JSON '''
+        return dumps_compact(self.getResponse(input_text, user_id, prediction, mode))
+
+    def handle_request(self, input_text, user_id, prediction=None):
+        ''' The dialogue logic of getResponse '''
 
         # Makes sure the user_id entries exists and updates the requests_num
         self.check_entries_and_request_num(user_id)
 
         # Update the Active Contexts/Intents and the Incomplete Intents Stack
-        self.update_active_contexts(user_id)
-        self.update_active_intents(user_id)
+        start = time.perf_counter()
+        self.update_active_entries(user_id)
+        self.metrics.observe('expiry', time.perf_counter() - start)
 
-        analyzed_text = self.get_intent_classification(input_text, user_id)
+        analyzed_text = self.get_intent_classification(input_text, user_id, prediction)
         # Add the 'active_contexts' and 'active_intents' entries
-        analyzed_text['active_contexts'] = [x[0] for x in list(self.get_active_contexts(user_id))]
+        analyzed_text['active_contexts'] = self.get_active_context_names(user_id)
         analyzed_text['active_intents'] = self.get_active_intents(user_id)
 
         # Info of the given Intent
-        intent = self.intents_info[analyzed_text['intent']['name']]
+        intent = self.intent_index[analyzed_text['intent']['name']]
 
         # Check if the given intent can be applied (Context and Follow-Up)
         if self.out_of_place_intent(intent, user_id):
             # Go to Fallback responses
-            response = select_sentence({}, self.fallback_responses)
+            response = self.render({}, self.fallback_templates)
             analyzed_text['response'] = response
             return analyzed_text
 
@@ -618,11 +896,13 @@ class AgentModel():
                 self.set_active_intent(analyzed_text, user_id)
 
                 # Update the active_intents/contexts entries
-                analyzed_text['active_contexts'] = [x[0] for x in list(self.get_active_contexts(user_id))]
+                analyzed_text['active_contexts'] = self.get_active_context_names(user_id)
                 analyzed_text['active_intents'] = self.get_active_intents(user_id)
 
                 # Apply the action for the specific intent
+                start = time.perf_counter()
                 analyzed_text = self.apply_intent_action(intent, analyzed_text, user_id)
+                self.metrics.observe('intent_action', time.perf_counter() - start)
 
                 # Return the respective response for the intent
                 analyzed_text['response'] = self.get_intent_response(intent, analyzed_text)
@@ -640,19 +920,100 @@ class AgentModel():
                 for parameter in needed_parameters:
                     # Check for the first missing parameter
                     if parameter not in analyzed_text['parameters']:
-                        analyzed_text['response'] = select_sentence(analyzed_text['parameters'],
-                                                                    intent['persistence_responses'][parameter])
+                        analyzed_text['response'] = self.render(analyzed_text['parameters'],
+                                                               intent.persistence_responses[parameter])
                         return analyzed_text
 
+    def getResponses(self, batch):
+        ''' Batched getResponse. Takes a list of (user_id, input_text) pairs.
+            All the sentences go through RasaNLU together, then every request
+            is handled in the given order, so each user's requests stay in order '''
+
+        batch = list(batch)
+        predictions = self.parse_texts([input_text for _, input_text in batch])
+
+        return [self.getResponse(input_text, user_id, prediction)
+                for (user_id, input_text), prediction in zip(batch, predictions)]
+
+    def metrics_snapshot(self):
+        ''' Per stage latencies, plus the parse cache counters '''
+        return {'stages': self.metrics.snapshot(),
+                'parse_cache': self.parse_cache.stats(),
+                'model_dir': self.model_dir,
+                'shadow': self.shadow_stats(),
+                'first_stage': self.first_stage.stats() if self.first_stage is not None else None,
+                'sessions': len(self.sessions),
+                'session_store': self.sessions.stats()}
+
+    def metrics_prometheus(self):
+        ''' The stage latencies in the Prometheus text format '''
+        return self.metrics.prometheus_text()
+
+    def start_metrics_dump(self, path, interval=15):
+        ''' Dump the Prometheus text to path every interval seconds '''
+        if self.metrics_dumper is None:
+            self.metrics_dumper = MetricsDumper(self.metrics, path, interval)
+            self.metrics_dumper.start()
+
+    def start_trace(self, path):
+        ''' Record every request to the JSONL file at path,
+            see benchmarks/replay.py for replaying them '''
+        self.stop_trace()
+        self.trace = TraceRecorder(path)
+
+    def stop_trace(self):
+        trace, self.trace = self.trace, None
+        if trace is not None:
+            trace.close()
+
+    def checkpoint_sessions(self, path=None):
+        ''' Write the live sessions to path, the checkpoint_path by default.
+            Each session is locked only while it is serialized '''
+        path = path or self.checkpoint_path
+
+        start = time.perf_counter()
+        count = write_checkpoint(path, self.sessions.snapshot(self.user_lock))
+        logger.info("%d sessions checkpointed to %s in %.2fs", count, path, time.perf_counter() - start)
+
+        return count
+
+    def restore_sessions(self, path):
+        ''' Restore the sessions of a checkpoint. Only idle sessions are dropped
+            here, each of the others is loaded on its user's next request and its
+            contexts/intents that expired meanwhile are dropped then '''
+        start = time.perf_counter()
+        try:
+            count = self.sessions.restore(read_checkpoint(path), self.intent_index, time.time())
+        except FileNotFoundError:
+            logger.info("No sessions checkpoint at %s", path)
+            return 0
+        except (OSError, ValueError, EOFError, pickle.UnpicklingError) as error:
+            logger.warning("Could not restore the sessions from %s: %s", path, error)
+            return 0
+
+        logger.info("%d sessions restored from %s in %.2fs", count, path, time.perf_counter() - start)
+        return count
+
+    def close(self):
+        ''' Stop the background threads, write the sessions still pending
+            and the last checkpoint '''
+        if self.model_watcher is not None:
+            self.model_watcher.stop()
+        self.stop_shadow()
+        self.stop_trace()
+        if self.metrics_dumper is not None:
+            self.metrics_dumper.stop()
+        if self.checkpointer is not None:
+            self.checkpointer.stop()
+            self.checkpoint_sessions()
+        self.sessions.close()
+
     def printResponse(self, input_text):
 
         prediction = self.getResponse(input_text)
 
-        if not isinstance(prediction['time_created'], str):
-            prediction['time_created'] = prediction['time_created'].strftime("%Y-%m-%d %H:%M:%S")
-
         if prediction != None:
-            print(json.dumps(prediction, indent=4, sort_keys=True))
+            print(dumps_pretty(prediction))
         else:
             print("Action Canceled")
 
@@ -661,6 +1022,8 @@ class AgentModel():
 
 if __name__ == "__main__":
 
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
     model = AgentModel()
     #from io_handler import IOHandler
     #io = IOHandler()
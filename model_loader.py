@@ -0,0 +1,237 @@
+# ModelLoader:     Loads the components of a trained RasaNLU model, in parallel
+#                  threads, and warms the pipeline up. Keeps how long each step
+#                  took, to track the cold-start time of the agent.
+# ModelWatcher:    Hot-reloads the agent when a newly trained model appears.
+# ShadowModel:     Compares a candidate model's intents with the serving one's.
+
+import os
+import random
+import logging
+import threading
+import collections
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+from nlu_pipeline import parse_batch, prune_pipeline
+from model_artifacts import read_manifest, load_mapped_component
+
+logger = logging.getLogger(__name__)
+
+# Representative sentences ran through the pipeline before serving,
+# so that the first real requests don't pay for lazy initializations
+WARMUP_SENTENCES = ["yes",
+                    "no, don't do it",
+                    "cancel",
+                    "I have a meeting with George next friday at 5pm",
+                    "add an assignment for tomorrow"]
+
+
+class ModelLoader():
+    ''' Same result as Interpreter.load, but the components are loaded side by
+        side, since loading spaCy, the pickled classifiers and duckling are mostly
+        independent. The context they provide is still merged in pipeline order, but
+        components loaded in parallel don't get the context of the ones before them,
+        which none of the RasaNLU 0.9 components reads on load.
+        Given needed_entities, extractors that can't output any of them aren't loaded.
+        With mapped, components exported by model_artifacts are loaded from their
+        memory-mappable copy, see mapped_components for which ones were '''
+
+    def __init__(self, model_dir, conf_file, parallel=True, needed_entities=None, mapped=True):
+        self.model_dir = model_dir
+        self.conf_file = conf_file
+        self.parallel = parallel
+        self.needed_entities = needed_entities
+        self.mapped = mapped
+        self.mapped_components = []
+
+        # Seconds spent on each step, in the order they finished
+        self.timings = {}
+
+    def load(self):
+        from rasa_nlu import components
+        from rasa_nlu.model import Metadata, Interpreter
+
+        start = perf_counter()
+        metadata = Metadata.load(self.model_dir)
+        components.validate_requirements(metadata.pipeline)
+        self.timings['metadata'] = perf_counter() - start
+
+        component_names = metadata.pipeline
+        if self.needed_entities is not None:
+            component_names, skipped = prune_pipeline(component_names, self.needed_entities)
+            if skipped:
+                logger.info("Skipping %s, none of their entities is used", ", ".join(skipped))
+
+        # No shared component cache, the builder is used from many threads
+        builder = components.ComponentBuilder(use_cache=False)
+        manifest = read_manifest(metadata.model_dir) if self.mapped else None
+
+        def load_component(component_name, **context):
+            component_start = perf_counter()
+            component = None
+            if manifest is not None:
+                component = load_mapped_component(component_name, metadata.model_dir, manifest)
+            if component is not None:
+                self.mapped_components.append(component_name)
+            else:
+                component = builder.load_component(component_name, metadata.model_dir, metadata, **context)
+            self.timings[component_name] = perf_counter() - component_start
+            return component
+
+        context = {}
+        if self.parallel:
+            with ThreadPoolExecutor(max_workers=len(component_names)) as pool:
+                pipeline = list(pool.map(load_component, component_names))
+            for component in pipeline:
+                updates = component.provide_context()
+                if updates:
+                    context.update(updates)
+        else:
+            # As Interpreter.load does
+            pipeline = []
+            for component_name in component_names:
+                component = load_component(component_name, **context)
+                updates = component.provide_context()
+                if updates:
+                    context.update(updates)
+                pipeline.append(component)
+
+        interpreter = Interpreter(pipeline, context, metadata)
+        self.timings['load'] = perf_counter() - start
+
+        return interpreter
+
+    def warm_up(self, interpreter, sentences=WARMUP_SENTENCES):
+        ''' Run the sentences through the pipeline, one by one and as a batch '''
+        start = perf_counter()
+
+        for sentence in sentences:
+            interpreter.parse(sentence)
+        parse_batch(interpreter, sentences)
+
+        self.timings['warmup'] = perf_counter() - start
+
+    def log_timings(self):
+        steps = ", ".join("%s %.2fs" % (step, seconds) for step, seconds in self.timings.items())
+        logger.info("Model %s loaded: %s", self.model_dir, steps)
+        if self.mapped_components:
+            logger.info("Memory-mapped: %s", ", ".join(self.mapped_components))
+
+
+def find_latest_model(models_root):
+    ''' The most recently trained model directory (one with a metadata.json)
+        under models_root, as rasa_nlu.train names them model_YYYYMMDD-HHMMSS '''
+    candidates = []
+
+    for name in os.listdir(models_root):
+        metadata_file = os.path.join(models_root, name, "metadata.json")
+        if os.path.isfile(metadata_file):
+            candidates.append((os.stat(metadata_file).st_mtime, name))
+
+    if not candidates:
+        return None
+
+    return os.path.join(models_root, max(candidates)[1])
+
+
+class ModelWatcher(threading.Thread):
+    ''' Polls a models directory and hot-reloads the agent's model
+        when a newer trained model appears in it '''
+
+    def __init__(self, agent, models_root, interval=10):
+        threading.Thread.__init__(self, name="model-watcher", daemon=True)
+        self.agent = agent
+        self.models_root = models_root
+        self.interval = interval
+        self.stopped = threading.Event()
+
+        # Directories already tried, a model that fails to load isn't retried
+        self.seen = set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                latest = find_latest_model(self.models_root)
+            except OSError:
+                logger.exception("Could not list %s", self.models_root)
+                continue
+
+            if latest is None or latest in self.seen:
+                continue
+
+            if os.path.abspath(latest) == os.path.abspath(self.agent.model_dir):
+                self.seen.add(latest)
+                continue
+
+            logger.info("New model found: %s", latest)
+            # None when another reload was in progress, tried again on the next poll
+            if self.agent.reload_model(latest, block=True) is not None:
+                self.seen.add(latest)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class ShadowModel():
+    ''' A candidate interpreter that parses a sampled fraction of the traffic
+        next to the serving one, off the request path, to measure how often
+        both models agree on the intent '''
+
+    def __init__(self, interpreter, model_dir, fraction, max_pending=100):
+        self.interpreter = interpreter
+        self.model_dir = model_dir
+        self.fraction = fraction
+        self.max_pending = max_pending
+
+        self.rng = random.Random()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.lock = threading.Lock()
+        self.pending = 0
+
+        self.compared = 0
+        self.agreed = 0
+        self.dropped = 0
+        self.disagreements = collections.Counter()
+
+    def sample(self, texts, predictions):
+        ''' Queue a sampled part of the parsed texts for comparison '''
+        sampled = [(text, prediction['intent']['name'])
+                   for text, prediction in zip(texts, predictions)
+                   if self.rng.random() < self.fraction]
+        if not sampled:
+            return
+
+        with self.lock:
+            # Never let the shadow model fall behind the serving one
+            if self.pending >= self.max_pending:
+                self.dropped += len(sampled)
+                return
+            self.pending += 1
+
+        self.executor.submit(self.compare, sampled)
+
+    def compare(self, sampled):
+        try:
+            shadow_predictions = parse_batch(self.interpreter, [text for text, _ in sampled])
+        except Exception:
+            logger.exception("The shadow model %s failed to parse", self.model_dir)
+            shadow_predictions = []
+
+        with self.lock:
+            self.pending -= 1
+            for (text, intent_name), shadow_prediction in zip(sampled, shadow_predictions):
+                self.compared += 1
+                if shadow_prediction['intent']['name'] == intent_name:
+                    self.agreed += 1
+                else:
+                    self.disagreements[(intent_name, shadow_prediction['intent']['name'])] += 1
+
+    def stats(self):
+        with self.lock:
+            return {'model_dir': self.model_dir,
+                    'compared': self.compared,
+                    'agreement': self.agreed / self.compared if self.compared else None,
+                    'dropped': self.dropped,
+                    'top_disagreements': self.disagreements.most_common(10)}
+
+    def close(self):
+        self.executor.shutdown(wait=False)
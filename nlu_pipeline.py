@@ -0,0 +1,163 @@
+# Batched Parsing:      Runs the RasaNLU pipeline of an Interpreter over many
+#                       sentences at once. Components that can work on a whole
+#                       batch get it in a single call, the rest run per sentence.
+# Pipeline Pruning:     Leaves out the extractors whose entities the agent never uses.
+
+# The intent ranking holds the top INTENT_RANKING_LENGTH intents, plus
+# any other intent within the ranking threshold of the best one, but never
+# more than INTENT_RANKING_LIMIT intents
+INTENT_RANKING_LENGTH = 10
+INTENT_RANKING_LIMIT = 100
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Batch versions of the RasaNLU components' process()
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def process_spacy_nlp(component, messages, context, **options):
+    ''' nlp_spacy: Let spaCy stream all the sentences through nlp.pipe '''
+
+    docs = component.nlp.pipe([message.text for message in messages])
+    for message, doc in zip(messages, docs):
+        message.set("spacy_doc", doc)
+
+
+def ranking_candidates(probabilities, ranking_length, ranking_threshold, ranking_limit=None):
+    ''' Per row, the ids of the ranking_length most probable intents and of
+        the ones within ranking_threshold of the best, most probable first,
+        at most ranking_limit of them. A partial selection picks the
+        ranking_limit best intents, only those get sorted '''
+    import numpy as np
+
+    if ranking_limit is None:
+        ranking_limit = INTENT_RANKING_LIMIT
+    num_intents = probabilities.shape[1]
+    limit = min(max(ranking_length, ranking_limit), num_intents)
+
+    if limit < num_intents:
+        best = np.argpartition(-probabilities, limit - 1, axis=1)[:, :limit]
+    else:
+        best = np.tile(np.arange(num_intents), (probabilities.shape[0], 1))
+
+    best_probabilities = np.take_along_axis(probabilities, best, axis=1)
+    order = np.argsort(-best_probabilities, axis=1, kind="stable")
+    best = np.take_along_axis(best, order, axis=1)
+    best_probabilities = np.take_along_axis(best_probabilities, order, axis=1)
+
+    # Past the first ranking_length, keep the ones close to the best
+    close = best_probabilities >= best_probabilities[:, :1] - ranking_threshold
+    keep = np.maximum(ranking_length, close.sum(axis=1))
+
+    return [row[:count] for row, count in zip(best, keep)]
+
+
+def process_sklearn_classifier(component, messages, context,
+                               ranking_length=INTENT_RANKING_LENGTH, ranking_threshold=0.0, **options):
+    ''' intent_classifier_sklearn: Classify the stacked feature vectors
+        of all the sentences with one predict_proba call. Only the
+        candidates of ranking_candidates make it to the intent ranking '''
+    import numpy as np
+
+    if not component.clf:
+        for message in messages:
+            message.set("intent", None, add_to_output=True)
+            message.set("intent_ranking", [], add_to_output=True)
+        return
+
+    X = np.vstack([message.get("text_features").reshape(1, -1) for message in messages])
+    probabilities = component.predict_prob(X)
+    sorted_ids = ranking_candidates(probabilities, ranking_length, ranking_threshold)
+
+    for message, intent_ids, probs in zip(messages, sorted_ids, probabilities):
+        intents = component.transform_labels_num2str(intent_ids)
+        intent_ranking = [{"name": name, "confidence": probs[intent_id]}
+                          for name, intent_id in zip(intents, intent_ids)]
+
+        if intent_ranking:
+            intent = dict(intent_ranking[0])
+        else:
+            intent = {"name": None, "confidence": 0.0}
+
+        message.set("intent", intent, add_to_output=True)
+        message.set("intent_ranking", intent_ranking, add_to_output=True)
+
+
+BATCH_PROCESSORS = {
+    "nlp_spacy": process_spacy_nlp,
+    "intent_classifier_sklearn": process_sklearn_classifier,
+}
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Pruning of the extractors whose output is thrown away
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# The entity types each pretrained extractor can output. ner_crf learns its
+# types from the training data, so it (and ner_synonyms after it) is always kept
+EXTRACTOR_ENTITIES = {
+    "ner_duckling": frozenset(["time", "number", "ordinal", "amount-of-money", "distance",
+                               "duration", "email", "phone-number", "quantity",
+                               "temperature", "url", "volume"]),
+    "ner_spacy": frozenset(["PERSON", "NORP", "FAC", "ORG", "GPE", "LOC", "PRODUCT",
+                            "EVENT", "WORK_OF_ART", "LAW", "LANGUAGE", "DATE", "TIME",
+                            "PERCENT", "MONEY", "QUANTITY", "ORDINAL", "CARDINAL"]),
+}
+
+
+def prune_pipeline(component_names, needed_entities):
+    ''' Returns the components to run, without the extractors none of whose
+        entity types are in needed_entities, and the skipped ones '''
+    kept = []
+    skipped = []
+
+    for name in component_names:
+        entities = EXTRACTOR_ENTITIES.get(name)
+        if entities is not None and not entities & needed_entities:
+            skipped.append(name)
+        else:
+            kept.append(name)
+
+    return kept, skipped
+
+
+def parse_batch(interpreter, texts, **options):
+    ''' Batched Interpreter.parse. Returns the parse output
+        of every sentence, in the order they were given. The options
+        go to the batch processors, e.g. ranking_length/ranking_threshold '''
+
+    # Interpreters without a RasaNLU pipeline only provide parse()
+    if not hasattr(interpreter, 'pipeline'):
+        return [interpreter.parse(text) for text in texts]
+
+    from rasa_nlu.training_data import Message
+
+    results = [None] * len(texts)
+    messages = []
+    positions = []
+
+    for position, text in enumerate(texts):
+        # Same as Interpreter.parse, empty sentences skip the pipeline
+        if not text:
+            output = interpreter.default_output_attributes()
+            output["text"] = ""
+            results[position] = output
+        else:
+            messages.append(Message(text, interpreter.default_output_attributes()))
+            positions.append(position)
+
+    if messages:
+        for component in interpreter.pipeline:
+            batch_process = BATCH_PROCESSORS.get(component.name)
+
+            if batch_process is not None:
+                batch_process(component, messages, interpreter.context, **options)
+            else:
+                for message in messages:
+                    component.process(message, **interpreter.context)
+
+    for position, message in zip(positions, messages):
+        output = interpreter.default_output_attributes()
+        output.update(message.as_dict(only_output_properties=True))
+        results[position] = output
+
+    return results
@@ -0,0 +1,263 @@
+# PreforkAgent:    Multi-process serving. The AgentModel (with the interpreter)
+#                  is loaded once in the parent, which then forks the workers, so
+#                  the pages of the loaded model stay shared copy-on-write. Every
+#                  request is routed by a hash of its user_id, so a user's
+#                  contexts, intents and IIS always live in the same worker.
+#                  Workers that die are forked again from the parent. Their
+#                  users' sessions are lost, unless the agent keeps them in a
+#                  persistent store (session_db). Checkpoints (checkpoint_path)
+#                  would only hold the parent's sessions, so they are refused.
+
+import os
+import gc
+import zlib
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# The AgentModel methods the workers answer
+WORKER_METHODS = frozenset(["getResponse", "getResponses", "getResponseJSON", "metrics_snapshot"])
+
+# Seconds to wait before forking a worker that died again within RESTART_WINDOW
+RESTART_BACKOFF = 1.0
+RESTART_WINDOW = 5.0
+
+
+class WorkerCrashed(RuntimeError):
+    ''' The worker handling the request died before answering '''
+
+
+def worker_main(agent, connection, inherited):
+    ''' Loop of a worker: run the requested AgentModel method, send back
+        (request_id, ok, result or error message) '''
+
+    # The parent's pipe ends, copied by the fork
+    for other in inherited:
+        other.close()
+
+    while True:
+        try:
+            message = connection.recv()
+        except (EOFError, OSError):
+            break
+        if message is None:
+            break
+
+        request_id, method, args = message
+        try:
+            reply = (request_id, True, getattr(agent, method)(*args))
+        except Exception as error:
+            reply = (request_id, False, "%s: %s" % (type(error).__name__, error))
+
+        connection.send(reply)
+
+    # Write the sessions a persistent store still holds
+    agent.sessions.close()
+
+
+class WorkerSlot():
+    ''' The parent's side of one worker: its process, pipe and pending requests '''
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.connection = None
+        self.send_lock = threading.Lock()
+        self.pending = {}
+        self.restarts = []
+
+
+class PreforkAgent():
+    ''' Same getResponse/getResponses as AgentModel, answered by forked workers,
+        plus a keyword-only timeout in seconds for the answer. The AgentModel
+        is built by agent_factory, or with agent_options '''
+
+    def __init__(self, workers=None, agent_factory=None, **agent_options):
+        if agent_options.get('checkpoint_path') is not None:
+            raise ValueError("The workers' sessions can't be checkpointed, use session_db with PreforkAgent")
+
+        self.num_workers = workers or os.cpu_count() or 1
+        self.agent_factory = agent_factory
+        self.agent_options = agent_options
+
+        self.agent = None
+        self.context = multiprocessing.get_context("fork")
+        self.slots = [WorkerSlot(index) for index in range(self.num_workers)]
+
+        # Forks happen one at a time, so that no worker inherits
+        # the child end of another worker's pipe
+        self.fork_lock = threading.Lock()
+        self.request_ids = iter(range(1, 2 ** 62))
+        self.ids_lock = threading.Lock()
+        self.closing = False
+
+    def start(self):
+        ''' Load the model, then fork the workers '''
+        if self.agent_factory is not None:
+            self.agent = self.agent_factory()
+        else:
+            from model_handler import AgentModel
+            self.agent = AgentModel(**self.agent_options)
+
+        checkpointer = getattr(self.agent, 'checkpointer', None)
+        if checkpointer is not None:
+            checkpointer.stop()
+            raise ValueError("The workers' sessions can't be checkpointed, use session_db with PreforkAgent")
+
+        self.agent.wait_until_ready()
+
+        # Keep the collector from touching (and so copying) the model's pages
+        gc.collect()
+        gc.freeze()
+
+        for slot in self.slots:
+            self.fork(slot)
+
+        return self
+
+    def fork(self, slot):
+        with self.fork_lock:
+            parent_end, child_end = self.context.Pipe()
+            # The parent's pipe ends the worker gets a copy of, its own included
+            inherited = [parent_end] + [other.connection for other in self.slots
+                                        if other is not slot and other.connection is not None]
+
+            process = self.context.Process(target=worker_main, args=(self.agent, child_end, inherited),
+                                           name="agent-worker-%d" % slot.index, daemon=True)
+            process.start()
+            child_end.close()
+
+            slot.process = process
+            slot.connection = parent_end
+
+        threading.Thread(target=self.read_replies, args=(slot, parent_end),
+                         name="agent-worker-%d-replies" % slot.index, daemon=True).start()
+        logger.info("Worker %d started, pid %d", slot.index, process.pid)
+
+    def read_replies(self, slot, connection):
+        ''' Resolve the slot's pending requests, restart the worker when it dies '''
+        while True:
+            try:
+                request_id, ok, result = connection.recv()
+            except (EOFError, OSError):
+                break
+
+            with slot.send_lock:
+                future = slot.pending.pop(request_id, None)
+            if future is None:
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(result))
+
+        self.worker_died(slot, connection)
+
+    def worker_died(self, slot, connection):
+        with slot.send_lock:
+            if slot.connection is not connection:
+                return
+            pending, slot.pending = slot.pending, {}
+            slot.connection = None
+
+        connection.close()
+        slot.process.join()
+        for future in pending.values():
+            future.set_exception(WorkerCrashed("Worker %d exited with code %s"
+                                               % (slot.index, slot.process.exitcode)))
+
+        if self.closing:
+            return
+
+        logger.error("Worker %d (pid %d) died with exit code %s, restarting it",
+                     slot.index, slot.process.pid, slot.process.exitcode)
+
+        # Don't fork in a tight loop if the worker keeps dying
+        now = time.time()
+        slot.restarts = [restart for restart in slot.restarts if now - restart < RESTART_WINDOW]
+        if slot.restarts:
+            time.sleep(RESTART_BACKOFF)
+        slot.restarts.append(now)
+
+        self.fork(slot)
+
+    def worker_for(self, user_id):
+        ''' The same user always goes to the same worker '''
+        return self.slots[zlib.crc32(str(user_id).encode("utf-8")) % self.num_workers]
+
+    def submit(self, slot, method, *args):
+        ''' Send a request to a worker, returns a Future of its result '''
+        if method not in WORKER_METHODS:
+            raise ValueError("Workers don't answer '%s'" % method)
+
+        with self.ids_lock:
+            request_id = next(self.request_ids)
+        future = Future()
+
+        with slot.send_lock:
+            if slot.connection is None:
+                raise WorkerCrashed("Worker %d is restarting" % slot.index)
+            slot.pending[request_id] = future
+            slot.connection.send((request_id, method, args))
+
+        return future
+
+    def getResponse(self, input_text, user_id='kimonas', prediction=None, mode=None, *, timeout=None):
+        return self.submit(self.worker_for(user_id), "getResponse",
+                           input_text, user_id, prediction, mode).result(timeout)
+
+    def getResponseJSON(self, input_text, user_id='kimonas', prediction=None, mode=None, *, timeout=None):
+        return self.submit(self.worker_for(user_id), "getResponseJSON",
+                           input_text, user_id, prediction, mode).result(timeout)
+
+    def getResponses(self, batch, *, timeout=None):
+        ''' Batched getResponse. Each worker gets the requests of its users as
+            one batch, in the given order, and the answers are put back in order '''
+        batch = list(batch)
+
+        groups = {}
+        for position, (user_id, input_text) in enumerate(batch):
+            slot = self.worker_for(user_id)
+            positions, requests = groups.setdefault(slot.index, ([], []))
+            positions.append(position)
+            requests.append((user_id, input_text))
+
+        futures = [(positions, self.submit(self.slots[index], "getResponses", requests))
+                   for index, (positions, requests) in groups.items()]
+
+        responses = [None] * len(batch)
+        for positions, future in futures:
+            for position, response in zip(positions, future.result(timeout)):
+                responses[position] = response
+
+        return responses
+
+    def stats(self):
+        ''' Per worker: pid, whether it is alive, restarts in the last window '''
+        return [{'worker': slot.index,
+                 'pid': slot.process.pid if slot.process is not None else None,
+                 'alive': slot.process is not None and slot.process.is_alive(),
+                 'pending': len(slot.pending),
+                 'recent_restarts': len(slot.restarts)}
+                for slot in self.slots]
+
+    def close(self, timeout=5):
+        self.closing = True
+
+        for slot in self.slots:
+            with slot.send_lock:
+                if slot.connection is not None:
+                    try:
+                        slot.connection.send(None)
+                    except OSError:
+                        pass
+
+        for slot in self.slots:
+            if slot.process is not None:
+                slot.process.join(timeout)
+                if slot.process.is_alive():
+                    slot.process.terminate()
@@ -0,0 +1,77 @@
+# Response Projections:   What getResponse returns to the caller, from the reply
+#                         alone up to the whole analyzed text for debugging.
+# Compact Serialization:  JSON without whitespace, with the encoders of the
+#                         non-JSON types (datetimes, sets, numpy floats) picked
+#                         by type once instead of converted field by field.
+
+import json
+from datetime import datetime, date
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Projections of the analyzed text
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+def project_reply(analyzed_text):
+    return {'response': analyzed_text.get('response')}
+
+
+def project_intent(analyzed_text):
+    return {'response': analyzed_text.get('response'),
+            'intent': analyzed_text['intent']['name'],
+            'confidence': analyzed_text['intent'].get('confidence')}
+
+
+def project_full(analyzed_text):
+    return analyzed_text
+
+
+PROJECTIONS = {
+    'reply': project_reply,
+    'intent': project_intent,
+    'full': project_full,
+}
+
+
+def get_projection(mode):
+    try:
+        return PROJECTIONS[mode]
+    except KeyError:
+        raise ValueError("Unknown response mode '%s', expected one of: %s"
+                         % (mode, ", ".join(PROJECTIONS)))
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# JSON encoding
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+# Encoder of each non-JSON type found in the analyzed texts
+ENCODERS = {
+    datetime: datetime.isoformat,
+    date: date.isoformat,
+    set: list,
+    frozenset: list,
+}
+
+
+def json_default(value):
+    ''' json.dumps fallback: datetimes, sets, and numpy scalars '''
+    encoder = ENCODERS.get(type(value))
+    if encoder is not None:
+        return encoder(value)
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+COMPACT_ENCODER = json.JSONEncoder(separators=(',', ':'), default=json_default)
+
+
+def dumps_compact(value):
+    ''' JSON with no whitespace, for the wire '''
+    return COMPACT_ENCODER.encode(value)
+
+
+def dumps_pretty(value):
+    ''' Indented, sorted JSON, for reading '''
+    return json.dumps(value, indent=4, sort_keys=True, default=json_default)
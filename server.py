@@ -0,0 +1,164 @@
+# AgentServer:     HTTP front end of the AgentModel, served by gevent. The
+#                  requests are answered through a MicroBatcher, so sentences
+#                  of concurrent users are parsed together. The batcher runs in
+#                  a greenlet: while a batch is parsed the requests arriving wait
+#                  in the socket backlog, and are read as the next batch's window
+#                  opens. Use PreforkAgent for more than one core.
+#
+#   POST /response  {"text": ..., "user_id": ..., "mode": optional}
+#   GET  /health    200 as long as the process serves
+#   GET  /ready     200 once the model is loaded, 503 before
+#   GET  /metrics   stage latencies in the Prometheus text format
+#
+# Run from the repository root:
+#   python server.py --port 5000
+#   python server.py --port 5000 --window-ms 10 --max-batch 64 --session-db sessions.db
+
+if __name__ == "__main__":
+    # Before anything creates a lock or a socket
+    from gevent import monkey
+    monkey.patch_all()
+
+import logging
+import argparse
+from concurrent.futures import TimeoutError
+from flask import Flask, Response, request
+from batching import MicroBatcher, Overloaded
+from serialization import get_projection, dumps_compact
+
+logger = logging.getLogger(__name__)
+
+# Seconds a request may take in total before getting a 504
+REQUEST_TIMEOUT = 10.0
+
+# Seconds the clients are told to wait after a 503
+RETRY_AFTER = "1"
+
+
+def json_response(body, status=200, headers=None):
+    return Response(dumps_compact(body), status=status, headers=headers, mimetype="application/json")
+
+
+def create_app(agent, batcher, request_timeout=REQUEST_TIMEOUT):
+    ''' The Flask app answering from the agent through the batcher '''
+    app = Flask(__name__)
+
+    @app.route("/response", methods=["POST"])
+    def response():
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            body = {}
+        text = body.get("text")
+        user_id = body.get("user_id")
+        # The user_id keys the sessions and their locks, so it must be hashable
+        if not isinstance(text, str) or not text.strip() or \
+                not isinstance(user_id, (str, int)) or isinstance(user_id, bool):
+            return json_response({'error': "Expected a JSON body with a non-empty 'text' "
+                                           "and a string or integer 'user_id'"}, 400)
+        user_id = str(user_id)
+
+        mode = body.get("mode")
+        if mode is not None:
+            try:
+                get_projection(mode)
+            except ValueError as error:
+                return json_response({'error': str(error)}, 400)
+
+        if not agent.is_ready():
+            return json_response({'error': "The model is loading"}, 503, {'Retry-After': RETRY_AFTER})
+
+        try:
+            future = batcher.submit(text, user_id, mode)
+        except Overloaded as error:
+            return json_response({'error': str(error)}, 503, {'Retry-After': RETRY_AFTER})
+
+        try:
+            reply = future.result(request_timeout)
+        except Overloaded as error:
+            return json_response({'error': str(error)}, 503, {'Retry-After': RETRY_AFTER})
+        except TimeoutError:
+            # Dropped if still queued. Once its batch is
+            # collected it is answered, and the session changes
+            future.cancel()
+            return json_response({'error': "Timed out"}, 504)
+        except Exception as error:
+            # Logged by the batcher
+            return json_response({'error': "%s: %s" % (type(error).__name__, error)}, 500)
+
+        return json_response(reply)
+
+    @app.route("/health")
+    def health():
+        return json_response({'status': "ok"})
+
+    @app.route("/ready")
+    def ready():
+        if agent.is_ready():
+            return json_response({'status': "ready", 'model_dir': agent.model_dir})
+        if agent.load_error is not None:
+            return json_response({'status': "failed", 'error': str(agent.load_error)}, 503)
+        return json_response({'status': "loading"}, 503, {'Retry-After': RETRY_AFTER})
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(agent.metrics_prometheus(), mimetype="text/plain; version=0.0.4")
+
+    @app.route("/stats")
+    def stats():
+        snapshot = agent.metrics_snapshot()
+        snapshot['batcher'] = batcher.stats()
+        return json_response(snapshot)
+
+    return app
+
+
+def serve(args):
+    import gevent
+    from gevent.pywsgi import WSGIServer
+    from model_handler import AgentModel
+
+    # Accept requests while the model loads, /ready tells when it can answer. The
+    # loading never yields, so it runs on a native thread of gevent's pool and the
+    # loader greenlet marks the model as ready back on the hub. The threads it would
+    # start there are greenlets, loading the components in parallel gains nothing
+    agent = AgentModel(model_dir=args.model, conf_file=args.config, session_db=args.session_db,
+                       background_load=True, parallel_load=False,
+                       load_runner=gevent.get_hub().threadpool.apply)
+
+    batcher = MicroBatcher(agent, window=args.window_ms / 1000.0, max_batch=args.max_batch,
+                           max_pending=args.max_pending, max_wait=args.max_wait_ms / 1000.0)
+
+    app = create_app(agent, batcher, args.timeout)
+    if args.cors:
+        from flask_cors import CORS
+        CORS(app)
+
+    server = WSGIServer((args.host, args.port), app, log=None)
+    logger.info("Listening on %s:%d", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        batcher.close()
+        agent.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="HTTP front end of the agent")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--model", default="Agent/models/model_001")
+    parser.add_argument("--config", default="Agent/config_spacy.json")
+    parser.add_argument("--session-db", help="keep the sessions in this SQLite file")
+    parser.add_argument("--window-ms", type=float, default=5, help="how long a batch is collected")
+    parser.add_argument("--max-batch", type=int, default=32, help="sentences parsed together at most")
+    parser.add_argument("--max-pending", type=int, default=1000, help="waiting requests before 503s")
+    parser.add_argument("--max-wait-ms", type=float, default=1000, help="queued longer, a request gets a 503")
+    parser.add_argument("--timeout", type=float, default=REQUEST_TIMEOUT, help="seconds before a 504")
+    parser.add_argument("--cors", action="store_true", help="allow cross-origin requests")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    serve(args)
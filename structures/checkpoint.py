@@ -0,0 +1,86 @@
+import os
+import time
+import pickle
+import logging
+import threading
+from structures.sessions import SESSION_FORMAT
+
+logger = logging.getLogger(__name__)
+
+# Version of the file layout
+CHECKPOINT_FORMAT = 2
+
+# Sessions pickled together, the file is written and read one chunk at a time
+CHECKPOINT_CHUNK = 10000
+
+
+def write_checkpoint(path, entries):
+    ''' Write the (user_id, last_seen, dump_session bytes) entries to path.
+        Written to a temp file first, a crash leaves the previous checkpoint.
+        The chunks are followed by None, so a truncated file is told apart
+        from a complete one. Returns the number of sessions written '''
+    temp_path = path + ".tmp"
+    count = 0
+
+    with open(temp_path, "wb") as checkpoint_file:
+        pickle.dump((CHECKPOINT_FORMAT, SESSION_FORMAT, time.time()), checkpoint_file,
+                    pickle.HIGHEST_PROTOCOL)
+
+        chunk = []
+        for entry in entries:
+            chunk.append(entry)
+            if len(chunk) == CHECKPOINT_CHUNK:
+                pickle.dump(chunk, checkpoint_file, pickle.HIGHEST_PROTOCOL)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            pickle.dump(chunk, checkpoint_file, pickle.HIGHEST_PROTOCOL)
+            count += len(chunk)
+        pickle.dump(None, checkpoint_file, pickle.HIGHEST_PROTOCOL)
+
+    os.replace(temp_path, path)
+    return count
+
+
+def read_checkpoint(path):
+    ''' The entries written by write_checkpoint, as they are read.
+        Raises ValueError for a file of another format or a truncated one,
+        once the entries before the truncation have been yielded '''
+    with open(path, "rb") as checkpoint_file:
+        try:
+            header = pickle.load(checkpoint_file)
+        except (EOFError, pickle.UnpicklingError):
+            raise ValueError("%s is not a checkpoint" % path)
+        if not isinstance(header, tuple) or header[:2] != (CHECKPOINT_FORMAT, SESSION_FORMAT):
+            raise ValueError("%s is a checkpoint of another format" % path)
+
+        while True:
+            try:
+                chunk = pickle.load(checkpoint_file)
+            except (EOFError, pickle.UnpicklingError):
+                raise ValueError("%s is truncated" % path)
+            if chunk is None:
+                return
+            yield from chunk
+
+
+class SessionCheckpointer(threading.Thread):
+    ''' Checkpoints the agent's sessions every interval seconds '''
+
+    def __init__(self, agent, interval):
+        threading.Thread.__init__(self, name="session-checkpointer", daemon=True)
+        self.agent = agent
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.agent.checkpoint_sessions()
+            except (OSError, pickle.PicklingError):
+                logger.exception("Could not checkpoint the sessions")
+
+    def stop(self):
+        ''' Returns once a checkpoint being written is done '''
+        self.stopped.set()
+        self.join()
@@ -7,3 +7,13 @@ class LastUpdatedOrderedDict(OrderedDict):
         if key in self:
             del self[key]
         OrderedDict.__setitem__(self, key, value)
+
+
+class LastUpdatedDict(dict):
+    'Plain dict version of LastUpdatedOrderedDict, smaller in memory'
+    __slots__ = ()
+
+    def __setitem__(self, key, value):
+        if key in self:
+            del self[key]
+        dict.__setitem__(self, key, value)
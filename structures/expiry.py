@@ -0,0 +1,72 @@
+import heapq
+
+
+class ExpiryEntry():
+    ''' Handle of an item pushed in an ExpiryQueue '''
+    __slots__ = ('item', 'alive')
+
+    def __init__(self, item):
+        self.item = item
+        self.alive = True
+
+
+class ExpiryQueue():
+    ''' Items with a time deadline (epoch seconds) and a requests deadline.
+        An item expires as soon as either of them is reached. Two min-heaps
+        keep the nearest deadlines on top, so only expired items are visited '''
+    __slots__ = ('by_time', 'by_request', 'counter')
+
+    def __init__(self):
+        self.by_time = []
+        self.by_request = []
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.by_time)
+
+    def push(self, item, time_deadline, request_deadline):
+        entry = ExpiryEntry(item)
+
+        # The counter keeps the heaps from ever comparing two entries
+        self.counter += 1
+        heapq.heappush(self.by_time, (time_deadline, self.counter, entry))
+        heapq.heappush(self.by_request, (request_deadline, self.counter, entry))
+
+        return entry
+
+    def cancel(self, entry):
+        ''' The entry is left in the heaps and skipped once it comes up '''
+        entry.alive = False
+
+    def pop_expired(self, now, requests_num):
+        ''' Returns the items whose time deadline has passed
+            or whose requests deadline has been reached '''
+        expired = []
+
+        while self.by_time and self.by_time[0][0] < now:
+            entry = heapq.heappop(self.by_time)[2]
+            if entry.alive:
+                entry.alive = False
+                expired.append(entry.item)
+
+        while self.by_request and self.by_request[0][0] <= requests_num:
+            entry = heapq.heappop(self.by_request)[2]
+            if entry.alive:
+                entry.alive = False
+                expired.append(entry.item)
+
+        return expired
+
+    def live_entries(self):
+        ''' (time_deadline, request_deadline, entry) of the
+            entries not expired or canceled yet, in push order '''
+        request_deadlines = {counter: deadline for deadline, counter, entry in self.by_request
+                             if entry.alive}
+
+        return [(time_deadline, request_deadlines[counter], entry)
+                for time_deadline, counter, entry in sorted(self.by_time, key=lambda pushed: pushed[1])
+                if entry.alive and counter in request_deadlines]
+
+    def clear(self):
+        self.by_time = []
+        self.by_request = []
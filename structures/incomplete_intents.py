@@ -0,0 +1,128 @@
+from collections import OrderedDict
+
+
+class PendingRequest():
+    ''' Handle of a request in the IncompleteIntents. Stays valid, and keeps
+        pointing to the same request, however the stack changes around it '''
+    __slots__ = ('id', 'request', 'intent', 'missing', 'record', 'expiry')
+
+    def __init__(self, handle_id, request, intent, missing):
+        self.id = handle_id
+        self.request = request
+        self.intent = intent
+        self.missing = missing
+
+        # The "<intent> - Parameters" IntentRecord and its ExpiryEntry
+        self.record = None
+        self.expiry = None
+
+    def first_missing(self):
+        ''' The next parameter to ask for, in the intent's order '''
+        for parameter in self.intent.parameters:
+            if parameter in self.missing:
+                return parameter
+        return None
+
+
+class IncompleteIntents():
+    ''' The Incomplete Intents Stack (IIS): requests still missing parameters,
+        most recent first. Each parameter maps to the requests missing it, so
+        slot filling, completion and removal don't walk the stack '''
+    __slots__ = ('pending', 'missing_index', 'counter')
+
+    def __init__(self):
+        # id -> PendingRequest, oldest first. Ids only grow, so a
+        # larger id is always a more recent request
+        self.pending = OrderedDict()
+        self.missing_index = {}
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def __bool__(self):
+        return bool(self.pending)
+
+    def __iter__(self):
+        ''' The PendingRequests, most recent first '''
+        return reversed(list(self.pending.values()))
+
+    def push(self, request, intent):
+        ''' Add a request of the (compiled) intent on top of the stack '''
+        self.counter += 1
+        missing = {parameter for parameter in intent.parameters
+                   if parameter not in request['parameters']}
+        pending = PendingRequest(self.counter, request, intent, missing)
+
+        self.pending[pending.id] = pending
+        for parameter in missing:
+            self.missing_index.setdefault(parameter, OrderedDict())[pending.id] = pending
+
+        return pending
+
+    def restore(self, handle_id, request, intent, missing):
+        ''' push, keeping the handle id of a saved request.
+            Saved requests must be restored oldest first '''
+        pending = PendingRequest(handle_id, request, intent, set(missing))
+
+        self.pending[pending.id] = pending
+        for parameter in pending.missing:
+            self.missing_index.setdefault(parameter, OrderedDict())[pending.id] = pending
+        self.counter = max(self.counter, handle_id)
+
+        return pending
+
+    def remove(self, pending):
+        ''' False if the request had already left the stack '''
+        if self.pending.pop(pending.id, None) is None:
+            return False
+
+        for parameter in pending.missing:
+            self.unindex(parameter, pending)
+
+        return True
+
+    def unindex(self, parameter, pending):
+        requests = self.missing_index.get(parameter)
+        if requests is not None:
+            requests.pop(pending.id, None)
+            if not requests:
+                del self.missing_index[parameter]
+
+    def top(self):
+        ''' The most recent request, None if the stack is empty '''
+        if not self.pending:
+            return None
+        return self.pending[next(reversed(self.pending))]
+
+    def most_recent_missing(self, parameters):
+        ''' The most recent request missing any of the given parameters '''
+        best = None
+
+        for parameter in parameters:
+            requests = self.missing_index.get(parameter)
+            if requests:
+                candidate = requests[next(reversed(requests))]
+                if best is None or candidate.id > best.id:
+                    best = candidate
+
+        return best
+
+    def fill(self, pending, parameters):
+        ''' Copy the parameters the request doesn't have yet into it.
+            Returns the number of parameters it still misses '''
+        request_parameters = pending.request['parameters']
+
+        for parameter, value in parameters.items():
+            if parameter not in request_parameters:
+                request_parameters[parameter] = value
+
+                if parameter in pending.missing:
+                    pending.missing.discard(parameter)
+                    self.unindex(parameter, pending)
+
+        return len(pending.missing)
+
+    def clear(self):
+        self.pending.clear()
+        self.missing_index.clear()
@@ -0,0 +1,113 @@
+# IntentIndex:     INTENTS and CONTEXTS compiled once, when the model
+#                  starts, into the lookups needed by the filtering.
+
+from structures.templates import compile_templates
+
+
+class CompiledIntent():
+    ''' The info of an intent in INTENTS, with its lists as frozensets and its
+        responses as Templates. Indexing it reads the original dict '''
+    __slots__ = ('name', 'data', 'parameters', 'context_needed', 'context_free',
+                 'follow_up', 'has_follow_up', 'context_set', 'is_information', 'is_cancel',
+                 'responses', 'persistence_responses')
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+        self.parameters = tuple(data['parameters'])
+
+        # Intents with no (or empty) 'context_needed' are in context everywhere
+        self.context_needed = frozenset(data.get('context_needed') or ())
+        self.context_free = not self.context_needed
+
+        self.has_follow_up = 'follow_up' in data
+        self.follow_up = frozenset(data.get('follow_up') or ())
+
+        self.context_set = data.get('context_set')
+
+        self.is_information = data['tag'] == 'Information'
+        self.is_cancel = data['tag'] == 'Cancel'
+
+        self.responses = compile_templates(data['response'])
+        self.persistence_responses = {parameter: compile_templates(sentences)
+                                      for parameter, sentences in data['persistence_responses'].items()}
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+
+class IntentIndex():
+    ''' Holds the CompiledIntent of every intent and the reverse maps:
+        context -> intents in context with it, parent -> its follow-up intents '''
+
+    def __init__(self, intents, contexts):
+        self.intents = {}
+        self.context_intents = {}
+        self.follow_ups = {}
+        self.context_free = set()
+
+        # Information/Cancel follow-ups, they also answer an incomplete intent
+        self.parameter_follow_ups = set()
+
+        for name, data in intents.items():
+            compiled = CompiledIntent(name, data)
+            self.intents[name] = compiled
+
+            if compiled.context_free:
+                self.context_free.add(name)
+
+            for context in compiled.context_needed:
+                self.context_intents.setdefault(context, set()).add(name)
+
+            for parent in compiled.follow_up:
+                self.follow_ups.setdefault(parent, set()).add(name)
+
+            if compiled.has_follow_up and (compiled.is_information or compiled.is_cancel):
+                self.parameter_follow_ups.add(name)
+
+        # The context free intents are in context with every context
+        self.context_free = frozenset(self.context_free)
+        self.context_intents = {context: self.context_free | names
+                                for context, names in self.context_intents.items()}
+        self.follow_ups = {parent: frozenset(names) for parent, names in self.follow_ups.items()}
+        self.parameter_follow_ups = frozenset(self.parameter_follow_ups)
+
+        self.validate(contexts)
+
+    def validate(self, contexts):
+        ''' Fail on start-up, instead of mid-conversation,
+            when an intent refers to unknown intents/contexts '''
+
+        for name, compiled in self.intents.items():
+
+            for context in compiled.context_needed:
+                if context not in contexts:
+                    raise ValueError("Intent '%s' needs unknown context '%s'" % (name, context))
+
+            if compiled.context_set is not None and compiled.context_set not in contexts:
+                raise ValueError("Intent '%s' sets unknown context '%s'" % (name, compiled.context_set))
+
+            for parent in compiled.follow_up:
+                if parent not in self.intents:
+                    raise ValueError("Intent '%s' follows up unknown intent '%s'" % (name, parent))
+
+    def __getitem__(self, name):
+        return self.intents[name]
+
+    def __contains__(self, name):
+        return name in self.intents
+
+    def intents_in_context(self, context):
+        ''' The names of the intents that can be applied while the given context is active '''
+        return self.context_intents.get(context, self.context_free)
+
+    def follow_ups_of(self, active_intent):
+        ''' The names of the intents that follow up the active intent '''
+        follow_ups = self.follow_ups.get(active_intent, frozenset())
+        if ' - Parameters' in active_intent:
+            return follow_ups | self.parameter_follow_ups
+        return follow_ups
@@ -0,0 +1,102 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    ''' Key used for the cache. Only the whitespace is normalized,
+        casing is kept since spaCy's NER and vectors depend on it '''
+    return " ".join(text.split())
+
+
+def model_fingerprint(model_dir):
+    ''' Changes whenever the model directory is retrained/replaced '''
+    try:
+        mtime = os.stat(os.path.join(model_dir, "metadata.json")).st_mtime
+    except OSError:
+        mtime = None
+
+    return (os.path.abspath(model_dir), mtime)
+
+
+def copy_prediction(prediction):
+    ''' Copy of a parse output, deep enough that the callers
+        can edit the dicts/lists they get without touching the cache '''
+    copied = {}
+
+    for key, value in prediction.items():
+        if isinstance(value, dict):
+            value = dict(value)
+        elif isinstance(value, list):
+            value = [dict(item) if isinstance(item, dict) else item for item in value]
+        copied[key] = value
+
+    return copied
+
+
+class ParseCache():
+    ''' Bounded LRU cache, with a time to live, for the raw output of
+        Interpreter.parse. Entries are dropped when the model changes.
+        Safe to share between threads '''
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.entries = OrderedDict()
+        self.model_key = None
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def bind(self, model_key):
+        ''' Set the model the cached results belong to. A different
+            model invalidates everything that was cached '''
+        with self.lock:
+            if model_key != self.model_key:
+                self.entries.clear()
+                self.model_key = model_key
+
+    def get(self, text):
+        ''' Returns a copy of the cached parse output, or None '''
+        key = normalize_text(text)
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is not None and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.entries.move_to_end(key)
+
+        prediction = copy_prediction(entry[1])
+        prediction['text'] = text
+        return prediction
+
+    def put(self, text, prediction):
+        if self.max_size <= 0:
+            return
+
+        key = normalize_text(text)
+        entry = (time.time(), copy_prediction(prediction))
+
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+
+            # Drop the least recently used entries
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.entries)}
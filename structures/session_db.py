@@ -0,0 +1,187 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from structures.sessions import SessionStore, dump_session, load_session
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    user_id TEXT PRIMARY KEY,
+    last_seen REAL NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen);
+'''
+
+
+class SQLiteSessionStore(SessionStore):
+    ''' SessionStore kept in a local SQLite file, so the sessions outlive
+        the process and can be shared by the workers of a PreforkAgent.
+        The sessions in memory are the cache reads go through, the disk
+        is only read for a user that isn't cached.
+
+        Writes are behind: save serializes the session (dump_session) and
+        a writer thread writes the pending ones every flush_interval seconds,
+        or as soon as batch_size are pending, in a single transaction.
+        A crash loses at most the last flush_interval seconds.
+
+        Every process opens its own connections and writer on first use,
+        so the store can be created before forking. Two processes must not
+        serve the same user, the PreforkAgent's routing makes sure of that '''
+
+    def __init__(self, path, idle_ttl, max_size, intent_index, flush_interval=1.0, batch_size=500):
+        SessionStore.__init__(self, idle_ttl, max_size)
+        self.path = path
+        self.intent_index = intent_index
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+
+        connection = self.connect()
+        connection.executescript(SCHEMA)
+        connection.close()
+
+        self.pid = None
+        self.open_lock = threading.Lock()
+        self.loads = 0
+        self.writes = 0
+        self.flushes = 0
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        # Readers don't wait for the writer, and the other processes' writers
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def open(self):
+        ''' Connections and writer of this process. Whatever was
+            inherited from the parent process is left alone '''
+        if self.pid == os.getpid():
+            return
+
+        with self.open_lock:
+            if self.pid == os.getpid():
+                return
+
+            self.reader = self.connect()
+            self.read_lock = threading.Lock()
+
+            # Taken from swapping the pending writes to committing them,
+            # so that an older batch is never committed after a newer one
+            self.writer_connection = self.connect()
+            self.write_lock = threading.Lock()
+
+            # user_id -> serialized session
+            self.pending = {}
+            self.pending_changed = threading.Condition()
+            self.closing = False
+
+            self.writer = threading.Thread(target=self.write_behind, name="session-writer", daemon=True)
+            self.writer.start()
+
+            # Last, the other threads don't wait for the lock once it is set
+            self.pid = os.getpid()
+
+    def load(self, user_id, now):
+        self.open()
+
+        with self.pending_changed:
+            data = self.pending.get(user_id)
+
+        if data is None:
+            with self.read_lock:
+                row = self.reader.execute("SELECT last_seen, data FROM sessions WHERE user_id = ?",
+                                          (user_id,)).fetchone()
+            if row is None or now - row[0] > self.idle_ttl:
+                return None
+            data = row[1]
+
+        self.loads += 1
+        try:
+            return load_session(data, self.intent_index)
+        except Exception:
+            logger.exception("Could not load the session of %s, starting a new one", user_id)
+            return None
+
+    def save(self, user_id):
+        session = self.sessions.get(user_id)
+        if session is None:
+            return
+
+        self.open()
+        data = dump_session(session)
+
+        with self.pending_changed:
+            self.pending[user_id] = data
+            if len(self.pending) >= self.batch_size:
+                self.pending_changed.notify()
+
+    def write_behind(self):
+        while True:
+            with self.pending_changed:
+                if not self.closing and len(self.pending) < self.batch_size:
+                    self.pending_changed.wait(self.flush_interval)
+                closing = self.closing
+
+            self.write_pending()
+            if closing:
+                break
+
+    def flush(self):
+        ''' Write the pending sessions now, instead of at the next interval '''
+        self.open()
+        self.write_pending()
+
+    def write_pending(self):
+        ''' The pending sessions, and the rows of the idle ones
+            removed, in one transaction '''
+        with self.write_lock:
+            with self.pending_changed:
+                pending, self.pending = self.pending, {}
+            if not pending:
+                return
+
+            now = time.time()
+            updates = [(user_id, now, data) for user_id, data in pending.items()]
+
+            try:
+                with self.writer_connection as connection:
+                    connection.executemany("INSERT OR REPLACE INTO sessions (user_id, last_seen, data) "
+                                           "VALUES (?, ?, ?)", updates)
+                    connection.execute("DELETE FROM sessions WHERE last_seen < ?", (now - self.idle_ttl,))
+            except sqlite3.Error:
+                logger.exception("Could not write %d sessions to %s", len(pending), self.path)
+                # Kept for the next flush, unless a newer version came in since
+                with self.pending_changed:
+                    for user_id, data in pending.items():
+                        self.pending.setdefault(user_id, data)
+                return
+
+            self.writes += len(pending)
+            self.flushes += 1
+
+    def stats(self):
+        stats = SessionStore.stats(self)
+        stats.update({'pending_writes': len(self.pending) if self.pid == os.getpid() else 0,
+                      'loads': self.loads,
+                      'writes': self.writes,
+                      'flushes': self.flushes})
+        return stats
+
+    def close(self):
+        if self.pid != os.getpid():
+            return
+
+        with self.pending_changed:
+            self.closing = True
+            self.pending_changed.notify()
+        self.writer.join()
+
+        with self.read_lock:
+            self.reader.close()
+        with self.write_lock:
+            self.writer_connection.close()
+        self.pid = None
@@ -0,0 +1,321 @@
+import time
+import pickle
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+from structures.custom_structs import LastUpdatedDict
+from structures.expiry import ExpiryQueue
+from structures.incomplete_intents import IncompleteIntents
+
+logger = logging.getLogger(__name__)
+
+# Version of the layout dump_session writes
+SESSION_FORMAT = 1
+
+
+# Immutable view of the active contexts/intents names, most recent first.
+# Shared by reference with every response built while it is current
+SessionView = namedtuple('SessionView', ['version', 'contexts', 'intents'])
+EMPTY_VIEW = SessionView(0, (), ())
+
+
+def remove_identical(entries, entry):
+    ''' Remove entry from the list, comparing by identity
+        since different dicts can have equal contents '''
+    for index, item in enumerate(entries):
+        if item is entry:
+            del entries[index]
+            return
+
+
+class IntentRecord():
+    ''' An active intent, with only what the expiry and the follow-ups read.
+        The parameters dict is shared with the analyzed text the intent was
+        set from, not copied, so it must not be edited afterwards.
+        Incomplete intents are named "<intent> - Parameters" and
+        hold the PendingRequest handle of their request in the IIS '''
+    __slots__ = ('name', 'parameters', 'time_created', 'request_num', 'request')
+
+    def __init__(self, name, parameters, time_created, request_num, request=None):
+        self.name = name
+        self.parameters = parameters
+        self.time_created = time_created
+        self.request_num = request_num
+        self.request = request
+
+
+class Session():
+    ''' All the conversation state of a single user '''
+    __slots__ = ('requests_num', 'contexts', 'intents', 'iis', 'expiry',
+                 'view', 'view_stale', 'last_seen')
+
+    def __init__(self):
+        self.requests_num = 0
+        self.contexts = LastUpdatedDict()
+        self.intents = []
+        self.iis = IncompleteIntents()
+        self.expiry = ExpiryQueue()
+        self.view = EMPTY_VIEW
+        self.view_stale = False
+        self.last_seen = time.time()
+
+    def expire(self, now):
+        ''' Removes the expired contexts and intents, keeping the IIS up to date '''
+        expired = self.expiry.pop_expired(now, self.requests_num)
+        if not expired:
+            return
+
+        for item in expired:
+
+            if item[0] == 'context':
+                _, context_name, context_content = item
+                # Skip contexts that have been set again since
+                if self.contexts.get(context_name) is context_content:
+                    del self.contexts[context_name]
+
+            else:
+                record = item[1]
+                remove_identical(self.intents, record)
+
+                # If it was an incomplete intent, then remove its request from the IIS
+                if record.request is not None:
+                    self.iis.remove(record.request)
+
+        # Invalidate the active contexts/intents view once, for all the removals
+        self.invalidate_view()
+
+    def invalidate_view(self):
+        ''' Called on every change of the contexts/intents '''
+        self.view_stale = True
+
+    def get_view(self):
+        ''' The current SessionView. It is rebuilt only
+            the first time it is needed after a change '''
+        if self.view_stale:
+            self.view = SessionView(self.view.version + 1,
+                                    tuple(reversed(list(self.contexts))),
+                                    tuple(intent.name for intent in self.intents))
+            self.view_stale = False
+
+        return self.view
+
+
+def dump_session(session):
+    ''' The session as compact bytes. Its data is pickled as plain tuples,
+        not the Session/IntentRecord/IIS classes, so the layout only changes
+        with SESSION_FORMAT. Dicts shared between the contexts and the
+        intents are written once, and are shared again once loaded '''
+    positions = {id(record): position for position, record in enumerate(session.intents)}
+
+    records = [(record.name, record.parameters, record.time_created, record.request_num,
+                record.request.id if record.request is not None else None)
+               for record in session.intents]
+
+    iis = [(pending.id, pending.request, pending.intent.name, sorted(pending.missing))
+           for pending in session.iis.pending.values()]
+
+    expiry = []
+    for time_deadline, request_deadline, entry in session.expiry.live_entries():
+        kind, *item = entry.item
+        if kind == 'intent':
+            # The intents are referred to by their position in the list
+            position = positions.get(id(item[0]))
+            if position is None:
+                continue
+            item = [position]
+        expiry.append((time_deadline, request_deadline, kind, *item))
+
+    state = (SESSION_FORMAT, session.requests_num, session.last_seen,
+             list(session.contexts.items()), records, iis, session.iis.counter, expiry)
+
+    return pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+
+
+def load_session(data, intent_index):
+    ''' The Session saved by dump_session. The IIS requests of intents
+        no longer in intent_index are dropped, with their records '''
+    state = pickle.loads(data)
+    if state[0] != SESSION_FORMAT:
+        raise ValueError("Unknown session format %r" % (state[0],))
+    _, requests_num, last_seen, contexts, records, iis, counter, expiry = state
+
+    session = Session()
+    session.requests_num = requests_num
+    session.last_seen = last_seen
+
+    for name, content in contexts:
+        session.contexts[name] = content
+
+    pending_requests = {}
+    for handle_id, request, intent_name, missing in iis:
+        if intent_name in intent_index:
+            pending_requests[handle_id] = session.iis.restore(handle_id, request,
+                                                              intent_index[intent_name], missing)
+    session.iis.counter = max(session.iis.counter, counter)
+
+    restored = []
+    for name, parameters, time_created, request_num, handle_id in records:
+        pending = pending_requests.get(handle_id)
+        if handle_id is not None and pending is None:
+            restored.append(None)
+            continue
+
+        record = IntentRecord(name, parameters, time_created, request_num, pending)
+        if pending is not None:
+            pending.record = record
+        session.intents.append(record)
+        restored.append(record)
+
+    for time_deadline, request_deadline, kind, *item in expiry:
+        if kind == 'intent':
+            record = restored[item[0]]
+            if record is None:
+                continue
+            entry = session.expiry.push(('intent', record), time_deadline, request_deadline)
+            if record.request is not None:
+                record.request.expiry = entry
+        else:
+            session.expiry.push((kind, *item), time_deadline, request_deadline)
+
+    session.invalidate_view()
+    return session
+
+
+class SessionStore():
+    ''' Holds the Session of every user, in least recently used order.
+        Sessions idle for more than idle_ttl seconds are evicted, as are
+        the least recently used ones when there are more than max_size.
+        The store itself is locked, each Session is guarded by its user's lock.
+
+        This is the in-memory store. Persistent stores subclass it, keeping
+        the sessions here as their cache, and implement load and save
+        (see structures/session_db.py) '''
+
+    def __init__(self, idle_ttl, max_size):
+        self.idle_ttl = idle_ttl
+        self.max_size = max(1, max_size)
+        self.sessions = OrderedDict()
+        self.lock = threading.RLock()
+
+        # Sessions restored from a checkpoint, as user_id -> (last_seen,
+        # dump_session bytes), until their user's next request
+        self.restored = {}
+        self.restored_index = None
+
+    def __getitem__(self, user_id):
+        return self.sessions[user_id]
+
+    def __contains__(self, user_id):
+        return user_id in self.sessions
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def get_or_create(self, user_id):
+        ''' Returns the user's Session, creating it if needed,
+            and marks it as the most recently used '''
+        now = time.time()
+
+        with self.lock:
+            session = self.sessions.get(user_id)
+            if session is not None:
+                self.sessions.move_to_end(user_id)
+                session.last_seen = now
+                self.evict(now)
+                return session
+
+        # Outside of the store's lock, loading may read the disk
+        session = self.load(user_id, now) or self.take_restored(user_id, now) or Session()
+
+        with self.lock:
+            session = self.sessions.setdefault(user_id, session)
+            session.last_seen = now
+            self.evict(now)
+
+        return session
+
+    def load(self, user_id, now):
+        ''' The saved Session of a user not in memory, None if there is none '''
+        return None
+
+    def save(self, user_id):
+        ''' Called after every request of the user, holding the user's lock '''
+
+    def restore(self, entries, intent_index, now):
+        ''' Keep the (user_id, last_seen, dump_session bytes) entries of a
+            checkpoint. Sessions idle for more than idle_ttl are dropped, the
+            others are only loaded on their user's next request.
+            Returns the number of sessions kept '''
+        restored = {user_id: (last_seen, data) for user_id, last_seen, data in entries
+                    if now - last_seen <= self.idle_ttl}
+
+        with self.lock:
+            for user_id in self.sessions:
+                restored.pop(user_id, None)
+            self.restored = restored
+            self.restored_index = intent_index
+
+        return len(restored)
+
+    def take_restored(self, user_id, now):
+        ''' The user's restored Session, without what expired meanwhile '''
+        entry = self.restored.pop(user_id, None)
+        if entry is None or now - entry[0] > self.idle_ttl:
+            return None
+
+        try:
+            session = load_session(entry[1], self.restored_index)
+        except Exception:
+            logger.exception("Could not restore the session of %s, starting a new one", user_id)
+            return None
+
+        session.expire(now)
+        return session
+
+    def snapshot(self, lock_for):
+        ''' (user_id, last_seen, dump_session bytes) of every session not idle
+            for more than idle_ttl, restored ones included. Each session is
+            dumped holding lock_for(user_id), and yielded once it is released.
+            The store isn't locked meanwhile '''
+        now = time.time()
+
+        with self.lock:
+            user_ids = list(self.sessions)
+            restored = list(self.restored.items())
+
+        for user_id in user_ids:
+            with lock_for(user_id):
+                session = self.sessions.get(user_id)
+                if session is None or now - session.last_seen > self.idle_ttl:
+                    continue
+                entry = (user_id, session.last_seen, dump_session(session))
+            yield entry
+
+        for user_id, (last_seen, data) in restored:
+            if now - last_seen <= self.idle_ttl:
+                yield user_id, last_seen, data
+            else:
+                self.restored.pop(user_id, None)
+
+    def stats(self):
+        return {'cached': len(self.sessions),
+                'restored': len(self.restored)}
+
+    def close(self):
+        ''' Write what is still pending '''
+
+    def evict(self, now=None):
+        ''' Drop the sessions over max_size and the idle ones. Both are
+            found at the front, so only the evicted sessions are visited '''
+        if now is None:
+            now = time.time()
+
+        with self.lock:
+            while len(self.sessions) > self.max_size:
+                self.sessions.popitem(last=False)
+
+            while self.sessions:
+                user_id = next(iter(self.sessions))
+                if now - self.sessions[user_id].last_seen <= self.idle_ttl:
+                    break
+                del self.sessions[user_id]
@@ -0,0 +1,87 @@
+import re
+
+# $parameter tokens. Parameter names are made of letters, digits, '_' and '-'
+# so punctuation right after them ("$time.", "$eventType?") is left as text
+PARAMETER_PATTERN = re.compile(r"\$([A-Za-z0-9_\-]*[A-Za-z0-9_])")
+
+
+class Template():
+    ''' A response sentence split once into text/parameter segments.
+        Even positions of parts hold text, odd positions parameter names '''
+    __slots__ = ('text', 'parts', 'parameters')
+
+    def __init__(self, text):
+        self.text = text
+        self.parts = tuple(PARAMETER_PATTERN.split(text))
+        self.parameters = self.parts[1::2]
+
+    def render(self, parameters_dict):
+        ''' Substitute the parameters with their values from the dict '''
+        if not self.parameters:
+            return self.text
+
+        parts = list(self.parts)
+        for index in range(1, len(parts), 2):
+            value = parameters_dict[parts[index]]
+            parts[index] = value if isinstance(value, str) else str(value)
+
+        return "".join(parts)
+
+    def __repr__(self):
+        return "Template(%r)" % self.text
+
+
+def compile_templates(sentences):
+    return tuple(Template(sentence) for sentence in sentences)
+
+
+def producible_parameters(compiled, index):
+    ''' The parameters an intent's analyzed text is sure to be able to hold:
+        its own, 'people', and the ones assign_context_parameters copies
+        from its needed contexts and the intents it follows up '''
+    parameters = set(compiled.parameters)
+    parameters.add('people')
+
+    for other in index.intents.values():
+        if other.context_set in compiled.context_needed:
+            parameters.update('context-' + parameter for parameter in other.parameters)
+            parameters.add('context-people')
+
+        if other.name in compiled.follow_up:
+            parameters.update('intent-' + parameter for parameter in other.parameters)
+            parameters.add('intent-people')
+
+    return parameters
+
+
+def check_templates(index, fallback_templates):
+    ''' Returns a list of problems with the compiled templates, found at
+        load time instead of as a KeyError/IndexError in the middle of a reply '''
+    problems = []
+
+    for name, compiled in index.intents.items():
+        available = producible_parameters(compiled, index)
+
+        if not compiled.responses and not compiled.is_information:
+            problems.append("Intent '%s' has no responses" % name)
+
+        templates = list(compiled.responses)
+        for parameter in compiled.parameters:
+            prompts = compiled.persistence_responses.get(parameter)
+            if not prompts:
+                problems.append("Intent '%s' has no persistence_responses for '%s'" % (name, parameter))
+            else:
+                templates.extend(prompts)
+
+        for template in templates:
+            for parameter in template.parameters:
+                if parameter not in available:
+                    problems.append("Intent '%s' can never provide $%s in %r"
+                                    % (name, parameter, template.text))
+
+    for template in fallback_templates:
+        for parameter in template.parameters:
+            problems.append("Fallback response %r uses $%s, fallbacks get no parameters"
+                            % (template.text, parameter))
+
+    return problems
@@ -0,0 +1,114 @@
+# Session checkpoints: written and read back chunk by chunk, refused when of
+# another format or truncated, and restored by a new agent on each user's
+# next request.
+#
+# Run from the repository root:
+#   python -m pytest -q tests
+
+import os
+import sys
+import time
+import pickle
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import structures.checkpoint
+from structures.checkpoint import write_checkpoint, read_checkpoint
+from model_handler import AgentModel
+from benchmarks.dialogue import StubInterpreter, synthetic_agent, LONG_LIFESPAN
+
+INTENTS, CONTEXTS = synthetic_agent(2, LONG_LIFESPAN)
+
+ENTRIES = [("user %d" % user, 1000.0 + user, b"session %d" % user) for user in range(7)]
+
+
+def make_agent(**options):
+    return AgentModel(interpreter=StubInterpreter(INTENTS), intents=INTENTS, contexts=CONTEXTS,
+                      fallback_responses=["Could you repeat that?"], parse_cache_size=0,
+                      response_mode='full', **options)
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(structures.checkpoint, "CHECKPOINT_CHUNK", 3)
+
+
+def test_round_trip(tmp_path, small_chunks):
+    path = str(tmp_path / "sessions.ckpt")
+
+    assert write_checkpoint(path, iter(ENTRIES)) == len(ENTRIES)
+    assert list(read_checkpoint(path)) == ENTRIES
+    assert not os.path.exists(path + ".tmp")
+
+
+def test_empty_checkpoint(tmp_path):
+    path = str(tmp_path / "sessions.ckpt")
+
+    assert write_checkpoint(path, []) == 0
+    assert list(read_checkpoint(path)) == []
+
+
+def test_other_format_is_refused(tmp_path):
+    path = str(tmp_path / "sessions.ckpt")
+    with open(path, "wb") as checkpoint_file:
+        pickle.dump((structures.checkpoint.CHECKPOINT_FORMAT - 1, 1, time.time()), checkpoint_file)
+        pickle.dump(ENTRIES, checkpoint_file)
+
+    with pytest.raises(ValueError, match="another format"):
+        list(read_checkpoint(path))
+
+
+def test_truncated_checkpoint_is_refused(tmp_path, small_chunks):
+    path = str(tmp_path / "sessions.ckpt")
+    write_checkpoint(path, ENTRIES)
+    with open(path, "rb") as checkpoint_file:
+        data = checkpoint_file.read()
+
+    # Wherever it is cut, chunk boundaries included
+    for size in range(len(data)):
+        with open(path, "wb") as checkpoint_file:
+            checkpoint_file.write(data[:size])
+        with pytest.raises(ValueError):
+            list(read_checkpoint(path))
+
+
+def test_sessions_are_restored_on_the_next_request(tmp_path):
+    path = str(tmp_path / "sessions.ckpt")
+
+    first = make_agent()
+    first.getResponse("Task 1|item=milk,when=today", "kimonas")
+    first.getResponse("Task 0|item=eggs", "kimonas")
+    first.getResponse("Positive", "someone else")
+    assert first.checkpoint_sessions(path) == 2
+
+    second = make_agent()
+    assert second.restore_sessions(path) == 2
+    assert "kimonas" not in second.sessions
+
+    # Fills the incomplete "Task 0"
+    analyzed_text = second.getResponse("Information|when=tomorrow", "kimonas")
+    assert analyzed_text['intent']['name'] == "Task 0"
+    assert analyzed_text['parameters']['item'] == "eggs"
+    assert analyzed_text['parameters']['when'] == "tomorrow"
+    assert "Task 1 Done" in analyzed_text['active_contexts']
+
+
+def test_truncated_checkpoint_restores_nothing(tmp_path):
+    path = str(tmp_path / "sessions.ckpt")
+
+    first = make_agent()
+    first.getResponse("Task 1|item=milk,when=today", "kimonas")
+    first.checkpoint_sessions(path)
+    with open(path, "rb+") as checkpoint_file:
+        checkpoint_file.truncate(os.path.getsize(path) - 1)
+
+    second = make_agent()
+    assert second.restore_sessions(path) == 0
+    assert second.restore_sessions(str(tmp_path / "missing.ckpt")) == 0
+
+    # Without the restored context, "Edit 1" gets the fallback
+    analyzed_text = second.getResponse("Edit 1", "kimonas")
+    assert analyzed_text['active_contexts'] == ()
+    assert analyzed_text['response'] == "Could you repeat that?"
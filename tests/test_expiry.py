@@ -0,0 +1,61 @@
+# ExpiryQueue: the time deadline is passed once now is after it, the
+# requests deadline is reached once requests_num gets to it.
+#
+# Run from the repository root:
+#   python -m pytest -q tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from structures.expiry import ExpiryQueue
+
+
+def test_time_deadline_is_exclusive():
+    queue = ExpiryQueue()
+    queue.push("context", 100.0, 50)
+
+    assert queue.pop_expired(100.0, 0) == []
+    assert queue.pop_expired(100.5, 0) == ["context"]
+
+
+def test_request_deadline_is_inclusive():
+    queue = ExpiryQueue()
+    queue.push("intent", 1000.0, 3)
+
+    assert queue.pop_expired(0.0, 2) == []
+    assert queue.pop_expired(0.0, 3) == ["intent"]
+
+
+def test_expired_once_by_either_deadline():
+    queue = ExpiryQueue()
+    queue.push("by time", 10.0, 100)
+    queue.push("by request", 1000.0, 2)
+    queue.push("alive", 1000.0, 100)
+
+    assert queue.pop_expired(20.0, 2) == ["by time", "by request"]
+    # Still in the other heap, but not returned again
+    assert queue.pop_expired(2000.0, 200) == ["alive"]
+    assert queue.pop_expired(3000.0, 300) == []
+
+
+def test_canceled_entries_never_expire():
+    queue = ExpiryQueue()
+    canceled = queue.push("canceled", 10.0, 1)
+    queue.push("kept", 10.0, 1)
+    queue.cancel(canceled)
+
+    assert queue.pop_expired(20.0, 0) == ["kept"]
+
+
+def test_live_entries_in_push_order():
+    queue = ExpiryQueue()
+    first = queue.push("first", 30.0, 5)
+    queue.push("expired", 10.0, 5)
+    canceled = queue.push("canceled", 40.0, 5)
+    last = queue.push("last", 20.0, 9)
+    queue.cancel(canceled)
+    queue.pop_expired(15.0, 0)
+
+    assert queue.live_entries() == [(30.0, 5, first), (20.0, 9, last)]
@@ -0,0 +1,97 @@
+# IncompleteIntents: the stack order, removal, and slot filling through the
+# missing parameter index.
+#
+# Run from the repository root:
+#   python -m pytest -q tests
+
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from structures.incomplete_intents import IncompleteIntents
+
+MEETING = SimpleNamespace(name="add_meeting", parameters=("person", "date", "time"))
+ASSIGNMENT = SimpleNamespace(name="add_assignment", parameters=("course", "date"))
+
+
+def request(**parameters):
+    return {'parameters': parameters}
+
+
+def test_push_keeps_the_most_recent_on_top():
+    iis = IncompleteIntents()
+    meeting = iis.push(request(person="George"), MEETING)
+    assignment = iis.push(request(), ASSIGNMENT)
+
+    assert len(iis) == 2
+    assert iis.top() is assignment
+    assert list(iis) == [assignment, meeting]
+    assert meeting.missing == {"date", "time"}
+    assert meeting.first_missing() == "date"
+
+
+def test_remove_takes_the_request_out_of_the_index():
+    iis = IncompleteIntents()
+    meeting = iis.push(request(), MEETING)
+    assignment = iis.push(request(), ASSIGNMENT)
+
+    assert iis.remove(assignment)
+    assert not iis.remove(assignment)
+    assert iis.top() is meeting
+    assert iis.most_recent_missing(["course"]) is None
+    assert iis.most_recent_missing(["date"]) is meeting
+
+    assert iis.remove(meeting)
+    assert not iis
+    assert iis.top() is None
+    assert iis.missing_index == {}
+
+
+def test_most_recent_missing_any_of_the_parameters():
+    iis = IncompleteIntents()
+    meeting = iis.push(request(), MEETING)
+    assignment = iis.push(request(), ASSIGNMENT)
+
+    assert iis.most_recent_missing(["time"]) is meeting
+    assert iis.most_recent_missing(["date"]) is assignment
+    assert iis.most_recent_missing(["time", "date"]) is assignment
+    assert iis.most_recent_missing(["unknown"]) is None
+
+
+def test_fill_only_adds_what_is_missing():
+    iis = IncompleteIntents()
+    meeting = iis.push(request(person="George"), MEETING)
+
+    assert iis.fill(meeting, {'person': "Nick", 'date': "tomorrow"}) == 1
+    assert meeting.request['parameters'] == {'person': "George", 'date': "tomorrow"}
+    assert meeting.first_missing() == "time"
+    assert iis.most_recent_missing(["date"]) is None
+
+    assert iis.fill(meeting, {'time': "5pm"}) == 0
+    assert iis.missing_index == {}
+    # Still on the stack until removed
+    assert iis.top() is meeting
+
+
+def test_filling_a_request_leaves_the_others_missing_it():
+    iis = IncompleteIntents()
+    meeting = iis.push(request(), MEETING)
+    assignment = iis.push(request(), ASSIGNMENT)
+
+    iis.fill(assignment, {'date': "friday"})
+
+    assert iis.most_recent_missing(["date"]) is meeting
+    assert "date" in meeting.missing
+
+
+def test_restore_keeps_the_ids_and_the_order():
+    iis = IncompleteIntents()
+    iis.restore(3, request(), MEETING, ["date", "time", "person"])
+    assignment = iis.restore(7, request(), ASSIGNMENT, ["course", "date"])
+    pushed = iis.push(request(), MEETING)
+
+    assert pushed.id == 8
+    assert iis.top() is pushed
+    assert iis.most_recent_missing(["course"]) is assignment
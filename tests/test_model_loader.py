@@ -0,0 +1,126 @@
+# ModelLoader.load with a stand-in for the rasa_nlu modules it imports,
+# loading the components both from their pickles and from the mapped copy.
+#
+# Run from the repository root:
+#   python -m pytest -q tests
+
+import os
+import sys
+import json
+import types
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model_loader import ModelLoader
+from model_artifacts import export_components
+
+PIPELINE = ["nlp_spacy", "intent_classifier_sklearn"]
+
+
+class Component():
+
+    def __init__(self, name, context):
+        self.name = name
+        self.loaded_with = context
+        self.weights = np.arange(2048, dtype=np.float64)
+
+    def provide_context(self):
+        return {'provided_by_' + self.name: True}
+
+
+class Interpreter():
+
+    def __init__(self, pipeline, context, metadata):
+        self.components = pipeline
+        self.context = context
+
+    def parse(self, text):
+        return {'text': text, 'intent': {'name': "greet", 'confidence': 1.0}}
+
+
+@pytest.fixture
+def model_dir(tmp_path, monkeypatch):
+    ''' A model directory, and the rasa_nlu modules ModelLoader imports '''
+    metadata = {'pipeline': PIPELINE, 'intent_classifier_sklearn': "intent_classifier.pkl"}
+    (tmp_path / "metadata.json").write_text(json.dumps(metadata))
+    (tmp_path / "intent_classifier.pkl").write_bytes(b"")
+
+    class Metadata():
+
+        def __init__(self, model_dir):
+            self.model_dir = model_dir
+            self.pipeline = PIPELINE
+
+        @staticmethod
+        def load(model_dir):
+            return Metadata(model_dir)
+
+    class ComponentBuilder():
+
+        def __init__(self, use_cache=True):
+            pass
+
+        def load_component(self, component_name, model_dir, metadata, **context):
+            return Component(component_name, context)
+
+    components = types.ModuleType("rasa_nlu.components")
+    components.ComponentBuilder = ComponentBuilder
+    components.validate_requirements = lambda pipeline: None
+
+    model = types.ModuleType("rasa_nlu.model")
+    model.Metadata = Metadata
+    model.Interpreter = Interpreter
+
+    rasa_nlu = types.ModuleType("rasa_nlu")
+    rasa_nlu.components = components
+    rasa_nlu.model = model
+
+    monkeypatch.setitem(sys.modules, "rasa_nlu", rasa_nlu)
+    monkeypatch.setitem(sys.modules, "rasa_nlu.components", components)
+    monkeypatch.setitem(sys.modules, "rasa_nlu.model", model)
+
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize("parallel", [True, False])
+def test_load_from_pickles(model_dir, parallel):
+    loader = ModelLoader(model_dir, "config.json", parallel=parallel)
+    interpreter = loader.load()
+    loader.warm_up(interpreter)
+    loader.log_timings()
+
+    assert [component.name for component in interpreter.components] == PIPELINE
+    assert interpreter.context == {'provided_by_nlp_spacy': True,
+                                   'provided_by_intent_classifier_sklearn': True}
+    assert loader.mapped_components == []
+    assert set(PIPELINE + ['metadata', 'load', 'warmup']) <= set(loader.timings)
+
+
+def test_sequential_load_passes_the_context(model_dir):
+    interpreter = ModelLoader(model_dir, "config.json", parallel=False).load()
+
+    assert interpreter.components[0].loaded_with == {}
+    assert interpreter.components[1].loaded_with == {'provided_by_nlp_spacy': True}
+
+
+def test_load_from_mapped_copy(model_dir):
+    exported = Component("intent_classifier_sklearn", {})
+    export_components(model_dir, {"intent_classifier_sklearn": exported})
+
+    loader = ModelLoader(model_dir, "config.json")
+    interpreter = loader.load()
+    loader.log_timings()
+
+    assert loader.mapped_components == ["intent_classifier_sklearn"]
+    classifier = interpreter.components[1]
+    assert isinstance(classifier.weights, np.memmap)
+    assert np.array_equal(classifier.weights, exported.weights)
+
+    # Unless turned off
+    loader = ModelLoader(model_dir, "config.json", mapped=False)
+    interpreter = loader.load()
+    assert loader.mapped_components == []
+    assert not isinstance(interpreter.components[1].weights, np.memmap)
@@ -0,0 +1,125 @@
+# dump_session/load_session, and the SQLiteSessionStore: sessions written
+# behind are loaded back by another agent, which goes on with the dialogs
+# as the first one would have.
+#
+# Run from the repository root:
+#   python -m pytest -q tests
+
+import os
+import sys
+import time
+import pickle
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from model_handler import AgentModel
+from structures.intent_index import IntentIndex
+from structures.session_db import SQLiteSessionStore
+from structures.sessions import dump_session, load_session
+from benchmarks.dialogue import StubInterpreter, synthetic_agent, LONG_LIFESPAN
+
+INTENTS, CONTEXTS = synthetic_agent(2, LONG_LIFESPAN)
+
+# Leaves an incomplete "Task 0" and a complete "Task 1" with its context
+OPENING = ["Task 1|item=milk,when=today", "Task 0|item=eggs", "Positive"]
+CLOSING = ["Edit 1", "Information|when=tomorrow", "Follow 0", "Cancel"]
+
+
+def make_agent(**options):
+    return AgentModel(interpreter=StubInterpreter(INTENTS), intents=INTENTS, contexts=CONTEXTS,
+                      fallback_responses=["Could you repeat that?"], parse_cache_size=0,
+                      response_mode='full', **options)
+
+
+def state(analyzed_text):
+    ''' What the dialogue decided, without the randomly picked response '''
+    return (analyzed_text['intent']['name'], analyzed_text['parameters'],
+            list(analyzed_text['active_contexts']), list(analyzed_text['active_intents']))
+
+
+def test_session_round_trip():
+    agent = make_agent()
+    for text in OPENING:
+        agent.getResponse(text, "kimonas")
+
+    session = agent.sessions["kimonas"]
+    data = dump_session(session)
+    loaded = load_session(data, agent.intent_index)
+
+    assert pickle.loads(dump_session(loaded)) == pickle.loads(data)
+    assert loaded.get_view()[1:] == session.get_view()[1:]
+
+    # The incomplete intent's record, request and expiry entry stay linked
+    pending = loaded.iis.top()
+    assert pending.intent.name == "Task 0"
+    assert pending.missing == {"when"}
+    assert pending.record in loaded.intents
+    assert pending.record.request is pending
+    assert pending.expiry.item == ('intent', pending.record)
+
+
+def test_requests_of_removed_intents_are_dropped():
+    agent = make_agent()
+    for text in OPENING:
+        agent.getResponse(text, "kimonas")
+    data = dump_session(agent.sessions["kimonas"])
+
+    intents = {name: info for name, info in INTENTS.items() if name not in ("Task 0", "Follow 0")}
+    loaded = load_session(data, IntentIndex(intents, CONTEXTS))
+
+    assert not loaded.iis
+    assert "Task 0 - Parameters" not in loaded.get_view().intents
+    assert "Task 1" in loaded.get_view().intents
+
+
+def test_written_behind_sessions_are_loaded_back(tmp_path):
+    path = str(tmp_path / "sessions.db")
+    reference = make_agent()
+
+    first = make_agent(session_db=path)
+    for text in OPENING:
+        first.getResponse(text, "kimonas")
+        reference.getResponse(text, "kimonas")
+    first.close()
+
+    # Another agent, as after a restart, with a single cached session
+    second = make_agent(session_db=path, max_sessions=1)
+    for text in CLOSING:
+        assert state(second.getResponse(text, "kimonas")) == state(reference.getResponse(text, "kimonas"))
+        # Evicts the session, it is loaded from the store on the next request
+        second.getResponse("Positive", "someone else")
+        reference.getResponse("Positive", "someone else")
+
+    assert second.sessions.stats()['loads'] >= len(CLOSING)
+    second.close()
+
+
+def test_pending_writes_are_read_before_the_disk(tmp_path):
+    intent_index = IntentIndex(INTENTS, CONTEXTS)
+    store = SQLiteSessionStore(str(tmp_path / "sessions.db"), 3600, 10, intent_index,
+                               flush_interval=3600)
+    session = store.get_or_create("kimonas")
+    session.requests_num = 7
+    store.save("kimonas")
+
+    # Not written yet, and not cached
+    del store.sessions["kimonas"]
+    assert store.load("kimonas", time.time()).requests_num == 7
+
+    store.flush()
+    assert store.stats()['pending_writes'] == 0
+    assert store.load("kimonas", time.time()).requests_num == 7
+    assert store.load("someone else", time.time()) is None
+    store.close()
+
+
+def test_idle_sessions_are_not_loaded(tmp_path):
+    intent_index = IntentIndex(INTENTS, CONTEXTS)
+    store = SQLiteSessionStore(str(tmp_path / "sessions.db"), 60, 10, intent_index)
+    store.get_or_create("kimonas")
+    store.save("kimonas")
+    store.flush()
+
+    assert store.load("kimonas", time.time()) is not None
+    assert store.load("kimonas", time.time() + 120) is None
+    store.close()
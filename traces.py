@@ -0,0 +1,51 @@
+# TraceRecorder:   Opt-in recording of every getResponse call to a JSONL file,
+#                  one line per request: user_id, text, time, the raw parse and
+#                  the final intent/response. benchmarks/replay.py replays them.
+
+import json
+import time
+import threading
+from serialization import json_default
+
+
+def read_trace(path):
+    ''' The records of a trace file, in the order they were written '''
+    with open(path) as trace_file:
+        return [json.loads(line) for line in trace_file if line.strip()]
+
+
+class TraceRecorder():
+    ''' Appends a JSON line per request to path. Safe to share between threads,
+        requests still running when it is closed aren't recorded '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a")
+        self.lock = threading.Lock()
+        self.closed = False
+        self.records = 0
+
+    def record(self, user_id, text, parse, response, timestamp=None):
+        line = json.dumps({'time': time.time() if timestamp is None else timestamp,
+                           'user_id': user_id,
+                           'text': text,
+                           'parse': parse,
+                           'intent': response['intent']['name'],
+                           'response': response.get('response')},
+                          default=json_default)
+
+        with self.lock:
+            if self.closed:
+                return
+            self.file.write(line + "\n")
+            self.records += 1
+
+    def flush(self):
+        with self.lock:
+            if not self.closed:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.file.close()